@@ -0,0 +1,400 @@
+"""main.py のCAPTCHA生成・負荷ベンチマーク（GUIなしで実行できる）
+
+使い方:
+    python captcha_bench.py render --count 500       # レンダラー/エンコード形式の比較
+    python captcha_bench.py stages --count 500       # 描画・エンコード・base64・JSONの段階別時間
+    python captcha_bench.py load --no-rate-limit --flows 1000 --concurrency 8          # Flaskテストクライアント経由
+    python captcha_bench.py load --no-rate-limit --serve --flows 1000 --concurrency 8  # ローカルでサーバーを起動して計測
+    python captcha_bench.py load --url http://127.0.0.1:2000 --flows 1000
+    python captcha_bench.py memory --sessions 5000   # セッションストアのメモリ増加
+
+load は --json で結果を保存し、--max-p99-ms を超えると終了コード1になる（CIでの性能劣化検知用）。
+リクエストはすべて固定のクライアントIP（CLIENT_IP）から送るので、レート制限を有効にしたままなら
+429の件数と割合がそのまま結果に出る。--url で計測するサーバーは
+RATE_LIMIT_ENABLED=0 TRUSTED_PROXY_COUNT=1 python main.py のように起動する
+（TRUSTED_PROXY_COUNT=1 でベンチが送る X-Forwarded-For を接続元として扱う。ループバックは疑わしいIP扱いのため）。
+"""
+import argparse
+import base64
+import http.client
+import json
+import logging
+import random
+import sys
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+import main
+
+USER_AGENT = 'Mozilla/5.0 (X11; Linux x86_64) captcha-bench'
+CLIENT_IP = '198.51.100.10'  # ベンチのリクエストはすべてこのIPから（TEST-NET-2）
+
+
+def bench_renderer(create_image, count):
+    """描画のみ / 描画+エンコード の1秒あたり枚数を測る"""
+    texts = [main.generate_captcha_text() for _ in range(count)]
+    create_image(texts[0])  # 初回のみの準備（グリフアトラス作成など）を除外
+
+    started = time.perf_counter()
+    images = [create_image(text) for text in texts]
+    render_time = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for image in images:
+        main.encode_captcha_image(image)
+    encode_time = time.perf_counter() - started
+
+    return {
+        'render_per_sec': count / render_time,
+        'total_per_sec': count / (render_time + encode_time)
+    }
+
+
+def run_renderers(count):
+    renderers = [('pil', main.create_captcha_image)]
+    if main.np is not None:
+        renderers.append(('numpy', main.create_captcha_image_numpy))
+    else:
+        print('numpy がインストールされていないため numpy レンダラーは省略します')
+
+    results = {}
+    print(f'レンダラー比較 ({count}枚)')
+    print(f'{"renderer":<10}{"描画 枚/秒":>14}{"描画+エンコード 枚/秒":>18}  ({main.CAPTCHA_IMAGE_FORMAT})')
+    for name, create_image in renderers:
+        result = bench_renderer(create_image, count)
+        results[name] = result
+        print(f'{name:<10}{result["render_per_sec"]:>14.1f}{result["total_per_sec"]:>18.1f}')
+
+    if 'numpy' in results:
+        speedup = results['numpy']['total_per_sec'] / results['pil']['total_per_sec']
+        print(f'numpy / pil: {speedup:.2f}x')
+    return results
+
+
+# (表示名, 形式, compress_level)
+ENCODINGS = [
+    ('png l1', 'png', 1),
+    ('png l6', 'png', 6),
+    ('png l9', 'png', 9),
+    ('png-palette l1', 'png-palette', 1),
+    ('png-palette l6', 'png-palette', 6),
+    ('png-palette l9', 'png-palette', 9),
+    ('webp', 'webp', None),
+]
+
+
+def run_encodings(count):
+    """形式ごとの1枚あたりバイト数（base64後も）とエンコード時間"""
+    renderers = [('pil', main.create_captcha_image)]
+    if main.np is not None:
+        renderers.append(('numpy', main.create_captcha_image_numpy))
+    encodings = [e for e in ENCODINGS if e[1] != 'webp' or main.features.check('webp')]
+
+    results = {}
+    print(f'エンコード比較 ({count}枚)')
+    print(f'{"renderer":<10}{"encoding":<18}{"bytes":>8}{"base64":>8}{"ms/枚":>8}')
+    for renderer, create_image in renderers:
+        images = [create_image(main.generate_captcha_text()) for _ in range(count)]
+        for name, image_format, level in encodings:
+            started = time.perf_counter()
+            encoded = [main.encode_captcha_image(image, image_format, level) for image in images]
+            elapsed = time.perf_counter() - started
+            size = sum(len(data) for data in encoded) / count
+            b64_size = sum(len(base64.b64encode(data)) for data in encoded) / count
+            ms = elapsed / count * 1000
+            results[(renderer, name)] = {'bytes': size, 'base64_bytes': b64_size, 'encode_ms': ms}
+            print(f'{renderer:<10}{name:<18}{size:>8.0f}{b64_size:>8.0f}{ms:>8.3f}')
+    return results
+
+
+def percentile(values, p):
+    """最近傍順位法のパーセンタイル（values はソート済み）"""
+    if not values:
+        return None
+    return values[min(len(values) - 1, round(p / 100 * (len(values) - 1)))]
+
+
+def latency_summary(samples):
+    values = sorted(samples)
+    return {
+        'count': len(values),
+        'mean_ms': sum(values) / len(values) * 1000 if values else None,
+        'p50_ms': percentile(values, 50) * 1000 if values else None,
+        'p95_ms': percentile(values, 95) * 1000 if values else None,
+        'p99_ms': percentile(values, 99) * 1000 if values else None,
+    }
+
+
+def run_stages(count):
+    """1リクエスト分の処理を段階ごとに計測（描画・エンコード・base64・JSON）"""
+    create_image = main.create_captcha_image
+    if main.CAPTCHA_RENDERER == 'numpy' and main.np is not None:
+        create_image = main.create_captcha_image_numpy
+    create_image(main.generate_captcha_text())
+
+    timings = {'render': [], 'encode': [], 'base64': [], 'json': []}
+    for _ in range(count):
+        text = main.generate_captcha_text()
+        started = time.perf_counter()
+        image = create_image(text)
+        rendered = time.perf_counter()
+        data = main.encode_captcha_image(image)
+        encoded = time.perf_counter()
+        b64 = base64.b64encode(data).decode()
+        b64_done = time.perf_counter()
+        json.dumps({'session_id': 'x' * 32, 'image': b64, 'choices': [text] * 5})
+        finished = time.perf_counter()
+        timings['render'].append(rendered - started)
+        timings['encode'].append(encoded - rendered)
+        timings['base64'].append(b64_done - encoded)
+        timings['json'].append(finished - b64_done)
+
+    results = {stage: latency_summary(samples) for stage, samples in timings.items()}
+    print(f'段階別時間 ({count}回, renderer={main.CAPTCHA_RENDERER}, format={main.CAPTCHA_IMAGE_FORMAT})')
+    print(f'{"stage":<10}{"mean ms":>10}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}')
+    for stage, result in results.items():
+        print(f'{stage:<10}{result["mean_ms"]:>10.3f}{result["p50_ms"]:>10.3f}'
+              f'{result["p95_ms"]:>10.3f}{result["p99_ms"]:>10.3f}')
+    return results
+
+
+class FlaskClient:
+    """Flaskテストクライアント経由（スレッドごとにクライアントを作る）"""
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def request(self, method, path, payload=None):
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = main.app.test_client()
+        response = client.open(path, method=method, json=payload,
+                                headers={'User-Agent': USER_AGENT},
+                                environ_base={'REMOTE_ADDR': CLIENT_IP})
+        return response.status_code, response.get_json(silent=True)
+
+
+class HTTPClient:
+    """稼働中のサーバーへHTTPで接続（スレッドごとにKeep-Alive接続を使い回す）"""
+
+    def __init__(self, url):
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self._local = threading.local()
+
+    def request(self, method, path, payload=None):
+        # サーバーが TRUSTED_PROXY_COUNT=1 のときだけ接続元として扱われる
+        headers = {'User-Agent': USER_AGENT, 'X-Forwarded-For': CLIENT_IP}
+        body = None
+        if payload is not None:
+            body = json.dumps(payload)
+            headers['Content-Type'] = 'application/json'
+        for attempt in range(2):
+            conn = getattr(self._local, 'conn', None)
+            if conn is None:
+                conn = self._local.conn = http.client.HTTPConnection(self.host, self.port, timeout=30)
+            try:
+                conn.request(method, path, body=body, headers=headers)
+                response = conn.getresponse()
+                data = response.read()
+                break
+            except (http.client.HTTPException, OSError):
+                conn.close()
+                self._local.conn = None
+                if attempt:
+                    raise
+        try:
+            return response.status, json.loads(data)
+        except ValueError:
+            return response.status, None
+
+
+def find_answer(data):
+    """同一プロセスで動いている場合はストア/トークンから正解を取り出す"""
+    session_id = data['session_id']
+    if main.CAPTCHA_STATELESS:
+        payload = main.load_signed_token(session_id)
+        for choice in data['choices']:
+            if payload and main.answer_hash(payload['n'], choice) == payload['a']:
+                return choice
+        return None
+    session = main.captcha_sessions.get(session_id)
+    return session.text if session else None
+
+
+statuses_lock = threading.Lock()
+
+
+def run_flow(client, in_process, timings, statuses):
+    """check → captcha（→ 画像URL）→ verify を1回実行"""
+    def timed(stage, method, path, payload=None):
+        started = time.perf_counter()
+        status, data = client.request(method, path, payload)
+        timings[stage].append(time.perf_counter() - started)
+        with statuses_lock:
+            statuses[f'{stage} {status}'] = statuses.get(f'{stage} {status}', 0) + 1
+        return status, data
+
+    status, _ = timed('check', 'POST', '/api/captcha/check', {})
+    if status != 200:
+        return False
+    status, data = timed('captcha', 'GET', '/api/captcha')
+    if status != 200 or not data:
+        return False
+    if data.get('image_url'):
+        timed('image', 'GET', data['image_url'])
+    answer = find_answer(data) if in_process else None
+    answer = answer or random.choice(data['choices'])
+    status, result = timed('verify', 'POST', '/api/captcha/verify',
+                           {'session_id': data['session_id'], 'answer': answer})
+    return status == 200 and bool(result and result.get('success'))
+
+
+def serve_in_background():
+    """ローカルにサーバーを立ててURLを返す（空いているポートを使う）"""
+    from werkzeug.middleware.proxy_fix import ProxyFix
+    from werkzeug.serving import make_server
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)  # リクエストごとのログを抑える
+    # ベンチ自身を信頼済みプロキシとして扱い、X-Forwarded-For の CLIENT_IP を接続元にする
+    server = make_server('127.0.0.1', 0, ProxyFix(main.app, x_for=1), threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f'http://127.0.0.1:{server.server_port}'
+
+
+def run_load(flows, concurrency, url=None, in_process=True, warmup=20):
+    """指定並列数でフローを流し、エンドポイントごとのレイテンシとスループットを出す
+
+    in_process: サーバーが同じプロセスで動いているか（正解の取得とプール統計に使う）
+    """
+    client = HTTPClient(url) if url else FlaskClient()
+    timings = {'check': [], 'captcha': [], 'image': [], 'verify': []}
+    statuses = {}
+    flow_times = []
+
+    # ウォームアップ（プール補充の開始・接続確立など）
+    for _ in range(warmup):
+        run_flow(client, in_process, {k: [] for k in timings}, {})
+
+    def worker(index):
+        started = time.perf_counter()
+        ok = run_flow(client, in_process, timings, statuses)
+        flow_times.append(time.perf_counter() - started)
+        return ok
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        verified = sum(executor.map(worker, range(flows)))
+    elapsed = time.perf_counter() - started
+
+    requests_done = sum(len(samples) for samples in timings.values())
+    rate_limited = sum(count for key, count in statuses.items() if key.endswith(' 429'))
+    results = {
+        'target': url or 'flask-test-client',
+        'flows': flows,
+        'concurrency': concurrency,
+        'elapsed_s': elapsed,
+        'flows_per_sec': flows / elapsed,
+        'requests_per_sec': requests_done / elapsed,
+        'verified': verified,
+        'flow': latency_summary(flow_times),
+        'endpoints': {stage: latency_summary(samples) for stage, samples in timings.items() if samples},
+        'statuses': statuses,
+        'rate_limited': rate_limited,
+        'rate_limited_ratio': rate_limited / requests_done if requests_done else 0.0,
+        'pool': main.captcha_pool.stats() if in_process else None,
+    }
+
+    print(f'負荷試験 target={results["target"]} flows={flows} concurrency={concurrency}')
+    print(f'{results["flows_per_sec"]:.1f} flows/s, {results["requests_per_sec"]:.1f} req/s, '
+          f'認証成功 {verified}/{flows}')
+    print(f'{"endpoint":<10}{"count":>8}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}')
+    for stage, result in [('flow', results['flow'])] + list(results['endpoints'].items()):
+        print(f'{stage:<10}{result["count"]:>8}{result["p50_ms"]:>10.2f}'
+              f'{result["p95_ms"]:>10.2f}{result["p99_ms"]:>10.2f}')
+    print('status:', ', '.join(f'{key}={count}' for key, count in sorted(statuses.items())))
+    print(f'429: {rate_limited}件 ({results["rate_limited_ratio"]:.1%})'
+          + ('  ※レート制限込みの結果（--no-rate-limit / RATE_LIMIT_ENABLED=0 で無効化）' if rate_limited else ''))
+    return results
+
+
+def run_memory(sessions):
+    """/api/captcha を繰り返したときのセッションストアのメモリ増加（tracemalloc）"""
+    main.RATE_LIMIT_ENABLED = False  # 1つのIPから繰り返すのでレート制限は外す
+    client = FlaskClient()
+    client.request('GET', '/api/captcha')
+    before_sessions = main.captcha_sessions.stats().get('active')
+
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    for _ in range(sessions):
+        client.request('GET', '/api/captcha')
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    growth = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    after_sessions = main.captcha_sessions.stats().get('active')
+    added = (after_sessions - before_sessions) if after_sessions is not None else sessions
+    results = {
+        'sessions': sessions,
+        'backend': main.captcha_sessions.stats()['backend'],
+        'growth_bytes': growth,
+        'bytes_per_session': growth / added if added else None,
+    }
+    print(f'セッションストアのメモリ増加 (backend={results["backend"]}, {sessions}回)')
+    print(f'合計 {growth / 1024:.1f} KiB'
+          + (f', 1セッションあたり {results["bytes_per_session"]:.0f} bytes' if added else ''))
+    return results
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description='CAPTCHA生成・負荷ベンチマーク')
+    subparsers = parser.add_subparsers(dest='command')
+
+    render_parser = subparsers.add_parser('render', help='レンダラーとエンコード形式の比較')
+    render_parser.add_argument('--count', type=int, default=500, help='生成する枚数')
+
+    stages_parser = subparsers.add_parser('stages', help='段階別の処理時間')
+    stages_parser.add_argument('--count', type=int, default=500, help='計測回数')
+
+    load_parser = subparsers.add_parser('load', help='check → captcha → verify の負荷試験')
+    load_parser.add_argument('--flows', type=int, default=500, help='実行するフロー数')
+    load_parser.add_argument('--concurrency', type=int, default=8, help='並列数')
+    target = load_parser.add_mutually_exclusive_group()
+    target.add_argument('--url', help='稼働中のサーバーのURL（省略時はFlaskテストクライアント）')
+    target.add_argument('--serve', action='store_true', help='このプロセス内でサーバーを起動して計測')
+    load_parser.add_argument('--no-rate-limit', action='store_true', help='同一プロセス内（テストクライアント/--serve）のレート制限を無効化')
+    load_parser.add_argument('--json', help='結果をJSONで保存するパス')
+    load_parser.add_argument('--max-p99-ms', type=float, help='フロー全体のp99がこれを超えたら失敗')
+
+    memory_parser = subparsers.add_parser('memory', help='セッションストアのメモリ増加')
+    memory_parser.add_argument('--sessions', type=int, default=2000, help='作成するセッション数')
+
+    args = parser.parse_args()
+    if args.command in (None, 'render'):
+        count = getattr(args, 'count', 500)
+        run_renderers(count)
+        print()
+        run_encodings(count)
+    elif args.command == 'stages':
+        run_stages(args.count)
+    elif args.command == 'memory':
+        run_memory(args.sessions)
+    elif args.command == 'load':
+        if args.no_rate_limit:
+            main.RATE_LIMIT_ENABLED = False
+        url = serve_in_background() if args.serve else args.url
+        results = run_load(args.flows, args.concurrency, url, in_process=args.url is None)
+        if args.json:
+            with open(args.json, 'w', encoding='utf-8') as f:
+                json.dump(results, f, ensure_ascii=False, indent=2)
+        if args.max_p99_ms is not None and results['flow']['p99_ms'] > args.max_p99_ms:
+            print(f'p99 {results["flow"]["p99_ms"]:.2f}ms が上限 {args.max_p99_ms}ms を超えました')
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main_cli()
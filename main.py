@@ -1,31 +1,481 @@
-from flask import Flask, request, jsonify, send_file
-from PIL import Image, ImageDraw, ImageFont
+from flask import Flask, Response, request, jsonify
+from PIL import Image, ImageDraw, ImageFont, features
+from werkzeug.middleware.proxy_fix import ProxyFix
 import random
 import string
 import hashlib
+import hmac
+import os
+import secrets
+import struct
 import time
 import json
 import io
+import atexit
 import base64
-from datetime import datetime, timedelta
+import bisect
+import functools
+import ipaddress
+import math
 import re
+import queue
+import threading
+import multiprocessing
+import sqlite3
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 app = Flask(__name__)
 
 # CAPTCHA設定
 CAPTCHA_LENGTH = 5
+CAPTCHA_CHARS = 'ABCDEFGHJKMNPQRSTUVWXYZ23456789'  # 読みやすい文字のみ使用（0,O,1,l,I等を除外）
+CAPTCHA_WIDTH, CAPTCHA_HEIGHT = 200, 80
+CAPTCHA_RENDERER = os.getenv("CAPTCHA_RENDERER", "pil")  # pil / numpy（NumPyがなければpil）
+
+# 画像エンコード設定（captcha_bench.py で形式ごとのサイズとエンコード時間を比較できる）
+# png: フルカラーPNG / png-palette: 減色したPNG（既定、サイズ約半分） / webp: 非可逆WebP
+IMAGE_MIMETYPES = {'png': 'image/png', 'png-palette': 'image/png', 'webp': 'image/webp'}
+CAPTCHA_IMAGE_FORMAT = os.getenv("CAPTCHA_IMAGE_FORMAT", "png-palette")
+if CAPTCHA_IMAGE_FORMAT not in IMAGE_MIMETYPES:
+    app.logger.warning(f'未対応のCAPTCHA_IMAGE_FORMAT: {CAPTCHA_IMAGE_FORMAT}（png-paletteを使用）')
+    CAPTCHA_IMAGE_FORMAT = 'png-palette'
+elif CAPTCHA_IMAGE_FORMAT == 'webp' and not features.check('webp'):
+    app.logger.warning('PillowがWebPに未対応のためpng-paletteを使用')
+    CAPTCHA_IMAGE_FORMAT = 'png-palette'
+CAPTCHA_PNG_COMPRESS_LEVEL = 6  # 9にしてもサイズは1割減程度でエンコード時間は3〜5倍
+CAPTCHA_PALETTE_COLORS = 16
+CAPTCHA_WEBP_QUALITY = 50
+CAPTCHA_WEBP_METHOD = 4  # 0〜6、大きいほど小さく遅い
+# inline: JSONにbase64で埋め込む / url: 保存済み画像のURLを返す（?image=url/inline で上書き可）
+CAPTCHA_IMAGE_DELIVERY = os.getenv("CAPTCHA_IMAGE_DELIVERY", "inline")
 CAPTCHA_EXPIRE_TIME = 300  # 5分
+CAPTCHA_MAX_SESSIONS = 100000  # 保持するセッション数の上限（超えたら古いものから削除）
+
+# セッションバックエンド設定
+# memory: プロセス内（単一プロセス用） / sqlite: 同一ホストの複数ワーカーで共有 / redis: 複数ホストで共有
+CAPTCHA_SESSION_BACKEND = os.getenv("CAPTCHA_SESSION_BACKEND", "memory")
+CAPTCHA_SESSION_DB = os.getenv("CAPTCHA_SESSION_DB", "captcha_sessions.sqlite3")  # /dev/shm 上に置けばメモリ上で共有できる
+CAPTCHA_REDIS_URL = os.getenv("CAPTCHA_REDIS_URL", "redis://localhost:6379/0")
+
+# ステートレスモード設定（署名付きトークンで答えを持ち回り、セッションを保存しない）
+CAPTCHA_STATELESS = os.getenv("CAPTCHA_STATELESS", "0") == "1"
+# 複数ワーカー/ホストで検証する場合は全プロセスで同じ鍵を設定すること
+CAPTCHA_SECRET = os.getenv("CAPTCHA_SECRET", "").encode() or secrets.token_bytes(32)
+CAPTCHA_REPLAY_FILTER_BITS = 1 << 20  # 使用済みトークン記録用ブルームフィルタのビット数（1世代128KB）
+CAPTCHA_REPLAY_FILTER_HASHES = 7
+
+# CAPTCHAプール設定
+CAPTCHA_POOL_SIZE = 200  # 事前生成して保持する枚数
+CAPTCHA_POOL_WORKERS = 2  # 生成用プロセス数
+CAPTCHA_POOL_REFILL_RATE = 100  # 1秒あたりの最大補充枚数
 
 # セッション管理
-captcha_sessions = {}
+class CaptchaSession:
+    """CAPTCHAセッション（__slots__で1件あたりのメモリを削減）"""
+    __slots__ = ('text', 'ip', 'user_agent', 'expires_at', 'verified', 'image', 'etag')
+
+    def __init__(self, text, ip, user_agent, image, etag):
+        self.text = text
+        self.ip = ip
+        self.user_agent = user_agent
+        self.expires_at = time.monotonic() + CAPTCHA_EXPIRE_TIME
+        self.verified = False
+        self.image = image  # 画像URL用に生成済みPNGを保持
+        self.etag = etag
+
+    def is_expired(self):
+        return time.monotonic() > self.expires_at
+
+    def remaining(self):
+        """残り有効秒数（共有バックエンドでは壁時計の期限に変換して保存する）"""
+        return self.expires_at - time.monotonic()
+
+    @classmethod
+    def restore(cls, text, ip, user_agent, image, etag, remaining, verified):
+        """共有バックエンドから読み込んだ値でセッションを復元"""
+        session = cls(text, ip, user_agent, image, etag)
+        session.expires_at = time.monotonic() + remaining
+        session.verified = bool(verified)
+        return session
+
+# セッションバックエンドは add / get / pop / mark_verified / stats を実装する
+class MemorySessionStore:
+    """期限順キューとLRU上限を持つプロセス内セッションストア（1リクエストあたり償却O(1)）"""
+
+    def __init__(self, max_sessions):
+        self.max_sessions = max_sessions
+        self._sessions = OrderedDict()  # session_id: CaptchaSession（LRU順）
+        self._expiry = deque()  # (期限, session_id) 有効期間が一定なので作成順 = 期限順
+        self._lock = threading.Lock()
+        self.expired = 0
+        self.evicted = 0
+
+    def add(self, session_id, session):
+        with self._lock:
+            self._expire(time.monotonic())
+            self._sessions[session_id] = session
+            self._expiry.append((session.expires_at, session_id))
+            # 上限を超えたら最も使われていないセッションを削除
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+                self.evicted += 1
+            # 削除済みセッションの期限エントリが溜まりすぎたら詰め直す
+            if len(self._expiry) > 2 * self.max_sessions:
+                self._expiry = deque(sorted((s.expires_at, sid) for sid, s in self._sessions.items()))
+
+    def get(self, session_id):
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is not None:
+                self._sessions.move_to_end(session_id)
+            return session
+
+    def pop(self, session_id):
+        with self._lock:
+            return self._sessions.pop(session_id, None)
+
+    def mark_verified(self, session_id, session):
+        session.verified = True
+
+    def _expire(self, now):
+        """期限切れのセッションをキューの先頭から削除"""
+        while self._expiry and self._expiry[0][0] <= now:
+            _, session_id = self._expiry.popleft()
+            session = self._sessions.get(session_id)
+            if session is not None and session.expires_at <= now:
+                del self._sessions[session_id]
+                self.expired += 1
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def stats(self):
+        return {
+            'backend': 'memory',
+            'active': len(self._sessions),
+            'max_sessions': self.max_sessions,
+            'expiry_queue': len(self._expiry),
+            'expired': self.expired,
+            'evicted': self.evicted
+        }
+
+class SQLiteSessionStore:
+    """SQLite(WAL)にセッションを保存し、同一ホストのワーカー間で共有する"""
+
+    PURGE_INTERVAL = 1.0  # 期限切れ削除の最小間隔（秒）
+
+    def __init__(self, path, max_sessions):
+        self.path = path
+        self.max_sessions = max_sessions
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+        self._last_purge = 0
+        self.expired = 0
+        self.evicted = 0
+
+    def _connection(self):
+        # fork後の子プロセスでは接続を開き直す
+        if self._conn is None or self._pid != os.getpid():
+            conn = sqlite3.connect(self.path, check_same_thread=False, timeout=5)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS captcha_sessions ("
+                "id TEXT PRIMARY KEY, text TEXT NOT NULL, ip TEXT, user_agent TEXT, "
+                "expires_at REAL NOT NULL, verified INTEGER NOT NULL DEFAULT 0, image BLOB, etag TEXT)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS captcha_sessions_expires ON captcha_sessions (expires_at)")
+            conn.commit()
+            self._conn = conn
+            self._pid = os.getpid()
+        return self._conn
+
+    def add(self, session_id, session):
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            conn.execute(
+                "INSERT OR REPLACE INTO captcha_sessions VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (session_id, session.text, session.ip, session.user_agent,
+                 now + session.remaining(), int(session.verified), session.image, session.etag)
+            )
+            if now - self._last_purge >= self.PURGE_INTERVAL:
+                self._purge(conn, now)
+            conn.commit()
+
+    def _purge(self, conn, now):
+        """期限切れと上限超過（期限の近い順 = 作成の古い順）のセッションを削除"""
+        self._last_purge = now
+        self.expired += conn.execute(
+            "DELETE FROM captcha_sessions WHERE expires_at <= ?", (now,)
+        ).rowcount
+        self.evicted += conn.execute(
+            "DELETE FROM captcha_sessions WHERE id IN ("
+            "SELECT id FROM captcha_sessions ORDER BY expires_at "
+            "LIMIT max(0, (SELECT COUNT(*) FROM captcha_sessions) - ?))",
+            (self.max_sessions,)
+        ).rowcount
+
+    def get(self, session_id):
+        with self._lock:
+            row = self._connection().execute(
+                "SELECT text, ip, user_agent, image, etag, expires_at, verified "
+                "FROM captcha_sessions WHERE id = ?", (session_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        text, ip, user_agent, image, etag, expires_at, verified = row
+        return CaptchaSession.restore(text, ip, user_agent, image, etag, expires_at - time.time(), verified)
+
+    def pop(self, session_id):
+        session = self.get(session_id)
+        if session is not None:
+            with self._lock:
+                conn = self._connection()
+                conn.execute("DELETE FROM captcha_sessions WHERE id = ?", (session_id,))
+                conn.commit()
+        return session
+
+    def mark_verified(self, session_id, session):
+        session.verified = True
+        with self._lock:
+            conn = self._connection()
+            conn.execute("UPDATE captcha_sessions SET verified = 1 WHERE id = ?", (session_id,))
+            conn.commit()
+
+    def stats(self):
+        with self._lock:
+            active = self._connection().execute(
+                "SELECT COUNT(*) FROM captcha_sessions WHERE expires_at > ?", (time.time(),)
+            ).fetchone()[0]
+        return {
+            'backend': 'sqlite',
+            'active': active,
+            'max_sessions': self.max_sessions,
+            'expired': self.expired,
+            'evicted': self.evicted
+        }
+
+class RedisSessionStore:
+    """Redisプロトコル互換サーバーにセッションを保存し、複数ホストで共有する
+
+    期限切れはキーのTTL、上限はサーバー側の maxmemory-policy に任せる。
+    client には redis.Redis 互換のクライアント（decode_responses=False）を渡す。
+    """
+
+    def __init__(self, client, prefix='captcha:session:'):
+        self.client = client
+        self.prefix = prefix
+
+    def _key(self, session_id):
+        return self.prefix + session_id
+
+    @staticmethod
+    def _ttl_ms(session):
+        return max(1, int(session.remaining() * 1000))
+
+    @staticmethod
+    def _decode(data):
+        if not data or b'text' not in data:
+            return None
+        text = lambda field: data.get(field, b'').decode()
+        return CaptchaSession.restore(
+            text(b'text'), text(b'ip'), text(b'user_agent'), data.get(b'image', b''), text(b'etag'),
+            float(data[b'expires_at']) - time.time(), data.get(b'verified') == b'1'
+        )
+
+    def add(self, session_id, session):
+        key = self._key(session_id)
+        pipe = self.client.pipeline()
+        pipe.hset(key, mapping={
+            'text': session.text,
+            'ip': session.ip,
+            'user_agent': session.user_agent,
+            'expires_at': time.time() + session.remaining(),
+            'verified': int(session.verified),
+            'image': session.image,
+            'etag': session.etag
+        })
+        pipe.pexpire(key, self._ttl_ms(session))
+        pipe.execute()
+
+    def get(self, session_id):
+        return self._decode(self.client.hgetall(self._key(session_id)))
+
+    def pop(self, session_id):
+        key = self._key(session_id)
+        pipe = self.client.pipeline()
+        pipe.hgetall(key)
+        pipe.delete(key)
+        data, _ = pipe.execute()
+        return self._decode(data)
+
+    def mark_verified(self, session_id, session):
+        session.verified = True
+        key = self._key(session_id)
+        pipe = self.client.pipeline()
+        pipe.hset(key, 'verified', 1)
+        pipe.pexpire(key, self._ttl_ms(session))
+        pipe.execute()
+
+    def stats(self):
+        return {'backend': 'redis', 'prefix': self.prefix}
+
+def create_session_store(backend):
+    """設定に応じたセッションバックエンドを作成"""
+    if backend == 'sqlite':
+        return SQLiteSessionStore(CAPTCHA_SESSION_DB, CAPTCHA_MAX_SESSIONS)
+    if backend == 'redis':
+        if redis is None:
+            raise RuntimeError('redisバックエンドには redis パッケージが必要です（pip install redis）')
+        return RedisSessionStore(redis.Redis.from_url(CAPTCHA_REDIS_URL))
+    return MemorySessionStore(CAPTCHA_MAX_SESSIONS)
+
+captcha_sessions = create_session_store(CAPTCHA_SESSION_BACKEND)
+
+# 署名付きトークン
+def b64url_encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+def b64url_decode(text):
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+def sign_token(payload):
+    """ペイロードをHMAC-SHA256で署名したトークンにする"""
+    body = b64url_encode(json.dumps(payload, separators=(',', ':')).encode())
+    signature = hmac.new(CAPTCHA_SECRET, body.encode(), hashlib.sha256).digest()
+    return body + '.' + b64url_encode(signature)
+
+def load_signed_token(token):
+    """署名を検証してペイロードを返す（不正ならNone、有効期限 exp は呼び出し側で確認）"""
+    try:
+        body, signature = token.split('.')
+        expected = hmac.new(CAPTCHA_SECRET, body.encode(), hashlib.sha256).digest()
+        if not hmac.compare_digest(b64url_decode(signature), expected):
+            return None
+        payload = json.loads(b64url_decode(body))
+    except (ValueError, AttributeError):
+        return None
+    return payload if isinstance(payload, dict) else None
+
+def answer_hash(salt, answer):
+    """鍵付きの答えハッシュ（鍵なしだと答えの候補が少なく総当たりできてしまう）"""
+    return hmac.new(CAPTCHA_SECRET, f"{salt}:{answer.upper()}".encode(), hashlib.sha256).hexdigest()[:32]
+
+def client_fingerprint(client_ip, user_agent):
+    return hmac.new(CAPTCHA_SECRET, f"{client_ip}\n{user_agent}".encode(), hashlib.sha256).hexdigest()[:16]
+
+def issue_captcha_token(answer, client_ip, user_agent):
+    """答えのハッシュとIP/UAを含む、期限付きのCAPTCHAトークンを発行"""
+    salt = secrets.token_urlsafe(12)
+    return sign_token({
+        'n': salt,
+        'a': answer_hash(salt, answer),
+        'f': client_fingerprint(client_ip, user_agent),
+        'exp': int(time.time()) + CAPTCHA_EXPIRE_TIME
+    })
+
+class ReplayFilter:
+    """使用済みトークンを記録する2世代のブルームフィルタ
+
+    世代の切り替え間隔をトークンの有効期間と同じにしているので、期限内のトークンは
+    必ずどちらかの世代に残る。偽陽性（未使用なのに使用済み扱い）はありうるが見逃しはない。
+    記録はプロセスごとなので、複数ワーカーでは同じワーカーへの再送だけを防げる。
+    """
+
+    def __init__(self, bits, hashes, period):
+        self.bits = bits
+        self.hashes = hashes
+        self.period = period
+        self._current = bytearray(bits // 8)
+        self._previous = bytearray(bits // 8)
+        self._rotated_at = time.monotonic()
+        self._lock = threading.Lock()
+        self.rejected = 0
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(key.encode(), digest_size=4 * self.hashes).digest()
+        return [position % self.bits for position in struct.unpack(f'<{self.hashes}I', digest)]
+
+    @staticmethod
+    def _contains(bitmap, positions):
+        return all(bitmap[p >> 3] & (1 << (p & 7)) for p in positions)
+
+    def check_and_add(self, key):
+        """未使用なら記録してTrue、使用済みならFalseを返す"""
+        positions = self._positions(key)
+        with self._lock:
+            now = time.monotonic()
+            if now - self._rotated_at >= self.period:
+                # 2世代以上経っていれば古い記録はすべて期限切れ
+                if now - self._rotated_at < 2 * self.period:
+                    self._previous = self._current
+                else:
+                    self._previous = bytearray(len(self._current))
+                self._current = bytearray(len(self._current))
+                self._rotated_at = now
+            if self._contains(self._current, positions) or self._contains(self._previous, positions):
+                self.rejected += 1
+                return False
+            for p in positions:
+                self._current[p >> 3] |= 1 << (p & 7)
+            return True
+
+    def stats(self):
+        with self._lock:
+            filled = int.from_bytes(self._current, 'little').bit_count()
+        return {
+            'bits': self.bits,
+            'hashes': self.hashes,
+            'fill_ratio': round(filled / self.bits, 4),
+            'rejected': self.rejected
+        }
+
+replay_filter = ReplayFilter(CAPTCHA_REPLAY_FILTER_BITS, CAPTCHA_REPLAY_FILTER_HASHES, CAPTCHA_EXPIRE_TIME)
 
 # VPN/プロキシの疑いがあるIPレンジ（例）
 SUSPICIOUS_IP_RANGES = [
     '10.0.0.0/8',
     '172.16.0.0/12',
     '192.168.0.0/16',
-    '127.0.0.0/8'
+    '127.0.0.0/8',
+    '::1/128',
+    'fc00::/7',
+    'fe80::/10'
 ]
+# VPN/データセンターのレンジ一覧（1行に1つのCIDR、#以降はコメント）
+SUSPICIOUS_IP_LIST = os.getenv("SUSPICIOUS_IP_LIST")
+CLIENT_CHECK_CACHE_SIZE = 65536  # (IP, UA) ごとの判定結果を保持する件数
+
+# 手前にいるリバースプロキシの段数（0: X-Forwarded-Forを信用せず接続元アドレスを使う）
+# 1以上ならProxyFixが右から数えてこの段数分だけX-Forwarded-Forを信用してremote_addrを解決する
+# nginx等の背後で動かすときは必ず設定する（0のままだと全員がプロキシのIPになり、
+# 127.0.0.1 などは疑わしいIPとして拒否され、レート制限も全員で1つのバケットを共有する）
+TRUSTED_PROXY_COUNT = int(os.getenv("TRUSTED_PROXY_COUNT", 0))
+if TRUSTED_PROXY_COUNT > 0:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_COUNT)
+
+# レート制限設定（IP/サブネットごとのトークンバケット、全CAPTCHAエンドポイントで共有）
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "1") == "1"
+RATE_LIMIT_RATE = 1.0  # 1秒あたりの回復トークン数
+RATE_LIMIT_BURST = 30  # バケットの容量
+RATE_LIMIT_MAX_CLIENTS = 100000  # 保持するバケット数の上限
+RATE_LIMIT_IPV4_PREFIX = 32
+RATE_LIMIT_IPV6_PREFIX = 64  # IPv6は通常 /64 単位で割り当てられる
+RATE_LIMIT_COSTS = {'generate_captcha': 3}  # 画像生成とセッション作成は重いので多めに消費（その他は1）
+RATE_LIMIT_EXEMPT = {'captcha_pool_stats', 'captcha_stats'}
 
 # 疑わしいUser-Agent
 SUSPICIOUS_USER_AGENTS = [
@@ -33,29 +483,204 @@ SUSPICIOUS_USER_AGENTS = [
     'python-requests', 'automated', 'headless'
 ]
 
+class IPRangeIndex:
+    """CIDRレンジを整数区間にして結合・ソートし、二分探索で O(log n) 判定する"""
+
+    def __init__(self, cidrs=()):
+        self._pending = {4: [], 6: []}
+        self._starts = {4: [], 6: []}
+        self._ends = {4: [], 6: []}
+        self.add_all(cidrs)
+
+    def add(self, cidr):
+        network = ipaddress.ip_network(cidr.strip(), strict=False)
+        self._pending[network.version].append((int(network.network_address), int(network.broadcast_address)))
+
+    def add_all(self, cidrs):
+        for cidr in cidrs:
+            self.add(cidr)
+        self._build()
+
+    def load_file(self, path):
+        """レンジ一覧ファイルを読み込む（不正な行は読み飛ばす）"""
+        skipped = 0
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                line = line.split('#', 1)[0].strip()
+                if not line:
+                    continue
+                try:
+                    self.add(line)
+                except ValueError:
+                    skipped += 1
+        self._build()
+        return skipped
+
+    def _build(self):
+        """既存の区間と追加分をまとめ、重なる区間を結合する"""
+        for version, pending in self._pending.items():
+            if not pending:
+                continue
+            intervals = sorted(list(zip(self._starts[version], self._ends[version])) + pending)
+            starts, ends = [], []
+            for start, end in intervals:
+                if ends and start <= ends[-1] + 1:
+                    ends[-1] = max(ends[-1], end)
+                else:
+                    starts.append(start)
+                    ends.append(end)
+            self._starts[version], self._ends[version] = starts, ends
+            pending.clear()
+
+    def __contains__(self, ip):
+        if ip.version == 6 and ip.ipv4_mapped:
+            ip = ip.ipv4_mapped
+        value = int(ip)
+        starts = self._starts[ip.version]
+        i = bisect.bisect_right(starts, value) - 1
+        return i >= 0 and value <= self._ends[ip.version][i]
+
+    def __len__(self):
+        return len(self._starts[4]) + len(self._starts[6])
+
+suspicious_ip_index = IPRangeIndex(SUSPICIOUS_IP_RANGES)
+if SUSPICIOUS_IP_LIST:
+    suspicious_ip_index.load_file(SUSPICIOUS_IP_LIST)
+
+# キーワードを1つの正規表現にまとめて1回の走査で判定
+SUSPICIOUS_USER_AGENT_PATTERN = re.compile(
+    '|'.join(re.escape(keyword) for keyword in SUSPICIOUS_USER_AGENTS), re.IGNORECASE
+)
+
+proxy_header_warned = False
+
+def get_client_ip():
+    """クライアントIP（プロキシ経由ならTRUSTED_PROXY_COUNTに従いProxyFixが解決済み）"""
+    global proxy_header_warned
+    if not TRUSTED_PROXY_COUNT and not proxy_header_warned and 'HTTP_X_FORWARDED_FOR' in request.environ:
+        # プロキシの背後なのに設定し忘れている可能性が高いので一度だけ知らせる
+        proxy_header_warned = True
+        app.logger.warning(f'X-Forwarded-For付きのリクエストを受信しましたが TRUSTED_PROXY_COUNT=0 のため無視します'
+                           f'（接続元 {request.remote_addr}）。リバースプロキシの背後ならプロキシの段数を設定してください')
+    return request.remote_addr
+
 def is_suspicious_ip(ip):
-    """IPアドレスが疑わしいかチェック"""
-    # 簡単な例 - 実際にはより高度なVPN/プロキシ検出が必要
-    private_ranges = ['10.', '172.', '192.168.', '127.']
-    return any(ip.startswith(range_) for range_ in private_ranges)
+    """IPアドレスが疑わしいかチェック（解釈できないIPも疑わしいとみなす）"""
+    try:
+        return ipaddress.ip_address(ip) in suspicious_ip_index
+    except ValueError:
+        return True
 
 def is_suspicious_user_agent(user_agent):
     """User-Agentが疑わしいかチェック"""
     if not user_agent:
         return True
     
-    user_agent_lower = user_agent.lower()
-    return any(suspicious in user_agent_lower for suspicious in SUSPICIOUS_USER_AGENTS)
+    return SUSPICIOUS_USER_AGENT_PATTERN.search(user_agent) is not None
+
+@functools.lru_cache(maxsize=CLIENT_CHECK_CACHE_SIZE)
+def is_suspicious_client(ip, user_agent):
+    """IP/UAの判定結果をメモ化（レンジ一覧を更新したら cache_clear() する）"""
+    return is_suspicious_ip(ip) or is_suspicious_user_agent(user_agent)
+
+# レート制限
+class TokenBucketLimiter:
+    """IP/サブネットごとのトークンバケット
+
+    バケットは [トークン数, 最終更新時刻] をLRU順のOrderedDictで持つ。ロックは取らない:
+    GIL下で辞書操作は不可分で、同じバケットへの同時更新でも誤差は数リクエスト分に留まる。
+    満タンまで回復したバケットは新規作成と同じなので、古いものから捨ててよい。
+    """
+
+    def __init__(self, rate, burst, max_clients):
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        self.idle_time = burst / rate  # この時間使われなければ満タン
+        self._buckets = OrderedDict()
+        self.limited = 0
+
+    def acquire(self, key, cost=1):
+        """トークンを消費できれば0、できなければ再試行までの秒数を返す"""
+        now = time.monotonic()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = [self.burst, now]
+            self._buckets[key] = bucket
+            self._evict(now)
+        else:
+            try:
+                self._buckets.move_to_end(key)
+            except KeyError:
+                pass  # 他のスレッドが削除した直後（このリクエストは手元のバケットで判定）
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+
+        if bucket[0] >= cost:
+            bucket[0] -= cost
+            return 0
+        self.limited += 1
+        return (cost - bucket[0]) / self.rate
+
+    def _evict(self, now):
+        """上限超過分と、満タンに戻った古いバケットを削除（1回の追加につき最大2件で償却O(1)）"""
+        buckets = self._buckets
+        try:
+            while len(buckets) > self.max_clients:
+                buckets.popitem(last=False)
+            for _ in range(2):
+                key, bucket = next(iter(buckets.items()))
+                if now - bucket[1] < self.idle_time:
+                    break
+                buckets.pop(key, None)
+        except (KeyError, StopIteration, RuntimeError):
+            pass
+
+    def stats(self):
+        return {
+            'clients': len(self._buckets),
+            'max_clients': self.max_clients,
+            'rate': self.rate,
+            'burst': self.burst,
+            'limited': self.limited
+        }
+
+rate_limiter = TokenBucketLimiter(RATE_LIMIT_RATE, RATE_LIMIT_BURST, RATE_LIMIT_MAX_CLIENTS)
+
+@functools.lru_cache(maxsize=CLIENT_CHECK_CACHE_SIZE)
+def rate_limit_key(ip):
+    """バケットのキー（IPv4はIP、IPv6は /64 のサブネット）"""
+    try:
+        address = ipaddress.ip_address(ip)
+    except ValueError:
+        return ip
+    prefix = RATE_LIMIT_IPV4_PREFIX if address.version == 4 else RATE_LIMIT_IPV6_PREFIX
+    return str(ipaddress.ip_network(f'{address}/{prefix}', strict=False))
+
+@app.before_request
+def apply_rate_limit():
+    """CAPTCHAエンドポイントへのリクエストをレート制限（超過時は429）"""
+    if not RATE_LIMIT_ENABLED or not request.path.startswith('/api/captcha'):
+        return None
+    if request.endpoint in RATE_LIMIT_EXEMPT:
+        return None
+    
+    retry_after = rate_limiter.acquire(rate_limit_key(get_client_ip()), RATE_LIMIT_COSTS.get(request.endpoint, 1))
+    if retry_after:
+        return jsonify({
+            'success': False,
+            'message': 'リクエストが多すぎます。しばらくしてから再試行してください',
+            'retry_after': math.ceil(retry_after)
+        }), 429, {'Retry-After': str(math.ceil(retry_after))}
+    return None
 
 def generate_captcha_text():
     """CAPTCHAテキストを生成"""
-    # 読みやすい文字のみ使用（0,O,1,l,I等を除外）
-    chars = 'ABCDEFGHJKMNPQRSTUVWXYZ23456789'
-    return ''.join(random.choice(chars) for _ in range(CAPTCHA_LENGTH))
+    return ''.join(random.choice(CAPTCHA_CHARS) for _ in range(CAPTCHA_LENGTH))
 
 def create_captcha_image(text):
     """CAPTCHA画像を生成"""
-    width, height = 200, 80
+    width, height = CAPTCHA_WIDTH, CAPTCHA_HEIGHT
     image = Image.new('RGB', (width, height), color='white')
     draw = ImageDraw.Draw(image)
     
@@ -95,14 +720,242 @@ def create_captcha_image(text):
     
     return image
 
+# NumPyレンダラー（文字は起動後に一度だけラスタライズし、描画はすべて配列演算で行う）
+CAPTCHA_GLYPH_SHEAR = 0.35  # 文字の傾き（せん断）の最大値
+glyph_atlas = None
+numpy_rng = None
+
+def build_glyph_atlas(chars, size=32):
+    """各文字のアルファマスクを (文字数, 高さ, 幅) の配列にまとめる（せん断用の余白込み）"""
+    try:
+        font = ImageFont.load_default(size=size)
+    except (TypeError, OSError):
+        # 古いPillowやFreeTypeなしの環境ではビットマップフォント
+        font = ImageFont.load_default()
+    boxes = [font.getbbox(char) for char in chars]
+    height = max(box[3] - box[1] for box in boxes) + 4
+    pad = int(np.ceil(CAPTCHA_GLYPH_SHEAR * height / 2))
+    width = max(box[2] - box[0] for box in boxes) + 4 + 2 * pad
+    atlas = np.zeros((len(chars), height, width), dtype=np.float32)
+    for i, (char, box) in enumerate(zip(chars, boxes)):
+        glyph = Image.new('L', (width, height), 0)
+        ImageDraw.Draw(glyph).text((pad + 2 - box[0], 2 - box[1]), char, fill=255, font=font)
+        atlas[i] = np.asarray(glyph, dtype=np.float32) / 255
+    return {char: i for i, char in enumerate(chars)}, atlas
+
+def line_pixels(rng, count, width, height):
+    """ランダムな線分count本の画素座標をまとめて返す"""
+    x0, x1 = rng.integers(0, width, (2, count))
+    y0, y1 = rng.integers(0, height, (2, count))
+    steps = np.maximum(np.abs(x1 - x0), np.abs(y1 - y0)).max() + 1
+    t = np.linspace(0, 1, steps)
+    xs = np.rint(x0[:, None] + (x1 - x0)[:, None] * t).astype(np.intp)
+    ys = np.rint(y0[:, None] + (y1 - y0)[:, None] * t).astype(np.intp)
+    return ys.ravel(), xs.ravel()
+
+def create_captcha_image_numpy(text):
+    """CAPTCHA画像を生成（NumPy版: ノイズ・線・文字の揺らぎ・波形歪みを配列演算で合成）"""
+    global glyph_atlas, numpy_rng
+    if glyph_atlas is None:
+        glyph_atlas = build_glyph_atlas(CAPTCHA_CHARS)
+        numpy_rng = np.random.default_rng()
+    index, atlas = glyph_atlas
+    rng = numpy_rng
+    width, height = CAPTCHA_WIDTH, CAPTCHA_HEIGHT
+    # RGBXの4バイトを1画素として扱い、最後の再標本化をuint32の1次元参照で済ませる
+    canvas = np.full((height, width, 4), 255, dtype=np.uint8)
+
+    # ノイズと線
+    canvas[rng.integers(0, height, 50), rng.integers(0, width, 50)] = 211
+    canvas[line_pixels(rng, 5, width, height)] = 128
+
+    # 文字ごとに傾き（行ごとの横ずらし）を付ける
+    count, glyph_h, glyph_w = len(text), atlas.shape[1], atlas.shape[2]
+    rows = np.arange(glyph_h) - glyph_h / 2
+    shifts = np.rint(rng.uniform(-CAPTCHA_GLYPH_SHEAR, CAPTCHA_GLYPH_SHEAR, (count, 1)) * rows).astype(np.intp)
+    columns = np.clip(np.arange(glyph_w) + shifts[:, :, None], 0, glyph_w - 1)
+    glyph_ids = np.array([index[char] for char in text])[:, None, None]
+    glyphs = atlas[glyph_ids, np.arange(glyph_h)[None, :, None], columns]
+    colors = rng.integers(0, 101, (count, 4)).astype(np.float32)
+    offsets = rng.integers(-8, 9, (count, 2))
+
+    # 位置を揺らしてアルファ合成
+    stride = (width - 20) / count
+    for i in range(count):
+        x = int(10 + i * stride + (stride - glyph_w) / 2) + offsets[i, 0] // 2
+        y = (height - glyph_h) // 2 + offsets[i, 1]
+        left, top = max(x, 0), max(y, 0)
+        right, bottom = min(x + glyph_w, width), min(y + glyph_h, height)
+        alpha = glyphs[i, top - y:bottom - y, left - x:right - x, None]
+        region = canvas[top:bottom, left:right].astype(np.float32)
+        canvas[top:bottom, left:right] = region + (colors[i] - region) * alpha
+
+    # 画像全体を正弦波で歪ませる（行は横に、列は縦にずらして1回で再標本化）
+    phase_x, phase_y = rng.uniform(0, 2 * np.pi, 2)
+    row_shift = np.rint(3 * np.sin(np.arange(height) / 9 + phase_x)).astype(np.intp)
+    col_shift = np.rint(2 * np.sin(np.arange(width) / 17 + phase_y)).astype(np.intp)
+    src_x = np.clip(np.arange(width)[None, :] + row_shift[:, None], 0, width - 1)
+    src_y = np.clip(np.arange(height)[:, None] + col_shift[None, :], 0, height - 1)
+    warped = np.take(canvas.view(np.uint32).ravel(), (src_y * width + src_x).ravel())
+
+    return Image.frombytes('RGB', (width, height), warped.tobytes(), 'raw', 'RGBX')
+
+def encode_captcha_image(image, image_format=None, compress_level=None):
+    """CAPTCHA画像を設定された形式のバイト列にエンコード"""
+    image_format = image_format or CAPTCHA_IMAGE_FORMAT
+    if compress_level is None:
+        compress_level = CAPTCHA_PNG_COMPRESS_LEVEL
+    img_buffer = io.BytesIO()
+    if image_format == 'webp':
+        image.save(img_buffer, format='WEBP', quality=CAPTCHA_WEBP_QUALITY, method=CAPTCHA_WEBP_METHOD)
+    elif image_format == 'png-palette':
+        image = image.quantize(colors=CAPTCHA_PALETTE_COLORS, method=Image.Quantize.FASTOCTREE)
+        image.save(img_buffer, format='PNG', compress_level=compress_level)
+    else:
+        image.save(img_buffer, format='PNG', compress_level=compress_level)
+    return img_buffer.getvalue()
+
+def render_captcha():
+    """CAPTCHAを1枚生成して (テキスト, 画像バイト列) を返す"""
+    text = generate_captcha_text()
+    if CAPTCHA_RENDERER == 'numpy' and np is not None:
+        image = create_captcha_image_numpy(text)
+    else:
+        image = create_captcha_image(text)
+    return text, encode_captcha_image(image)
+
+def render_captcha_batch(count):
+    """プロセスプール用: まとめて生成して受け渡し回数を減らす"""
+    return [render_captcha() for _ in range(count)]
+
+class CaptchaPool:
+    """事前生成したCAPTCHAを保持し、バックグラウンドのプロセスプールで補充する"""
+
+    def __init__(self, size, workers, refill_rate):
+        self.size = size
+        self.workers = workers
+        self.refill_rate = refill_rate
+        self.pool = queue.Queue(maxsize=size)
+        self.hits = 0
+        self.misses = 0
+        self.rendered = 0
+        self._lock = threading.Lock()
+        self._started = False
+        self._stopped = threading.Event()
+
+    def ensure_started(self):
+        """補充スレッドを起動（gunicorn等のfork後に各プロセスで起動するよう遅延）"""
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        atexit.register(self.shutdown)
+        threading.Thread(target=self._refill_loop, name='captcha-pool', daemon=True).start()
+
+    def shutdown(self):
+        """補充を止める（補充スレッドがプロセスプールを閉じて終了する）"""
+        self._stopped.set()
+
+    def _refill_loop(self):
+        executor = None
+        batch_size = max(1, self.refill_rate // (self.workers * 4))
+        while not self._stopped.is_set():
+            missing = self.size - self.pool.qsize()
+            if missing <= 0:
+                time.sleep(0.1)
+                continue
+
+            started = time.time()
+            batches = [min(batch_size, missing - i) for i in range(0, missing, batch_size)][:self.workers * 4]
+            try:
+                if executor is None:
+                    # スレッドのあるプロセスからのforkはデッドロックしうるためspawnを使う
+                    executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                   mp_context=multiprocessing.get_context('spawn'))
+                for batch in executor.map(render_captcha_batch, batches):
+                    for item in batch:
+                        try:
+                            self.pool.put_nowait(item)
+                            self.rendered += 1
+                        except queue.Full:
+                            break
+            except Exception as e:
+                # 終了時は concurrent.futures がatexitより先にプールを閉じるので、少し待ってshutdown()を確認する
+                if self._stopped.wait(1):
+                    break
+                app.logger.error(f'CAPTCHAプール補充エラー: {e}')
+                # 壊れたプロセスプールは作り直す
+                if executor is not None:
+                    executor.shutdown(wait=False, cancel_futures=True)
+                executor = None
+                continue
+
+            # 補充レートを制限
+            min_interval = sum(batches) / self.refill_rate
+            elapsed = time.time() - started
+            if elapsed < min_interval:
+                time.sleep(min_interval - elapsed)
+
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def get(self):
+        """プールから1枚取り出す（空ならその場で生成）"""
+        self.ensure_started()
+        try:
+            item = self.pool.get_nowait()
+            self.hits += 1
+            return item
+        except queue.Empty:
+            self.misses += 1
+            return render_captcha()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'depth': self.pool.qsize(),
+            'target_depth': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / total, 3) if total else None,
+            'rendered': self.rendered
+        }
+
+captcha_pool = CaptchaPool(CAPTCHA_POOL_SIZE, CAPTCHA_POOL_WORKERS, CAPTCHA_POOL_REFILL_RATE)
+
+def create_invalid_image():
+    """無効なセッション用のプレースホルダー画像（起動時に1回だけ生成）"""
+    img = Image.new('RGB', (200, 80), color='lightgray')
+    draw = ImageDraw.Draw(img)
+    draw.text((50, 30), 'Invalid', fill='black')
+    
+    img_buffer = io.BytesIO()
+    img.save(img_buffer, format='PNG')
+    return img_buffer.getvalue()
+
+INVALID_CAPTCHA_PNG = create_invalid_image()
+
+def image_etag(image_bytes):
+    """画像バイト列のETag"""
+    return '"' + hashlib.sha256(image_bytes).hexdigest()[:16] + '"'
+
+INVALID_CAPTCHA_ETAG = image_etag(INVALID_CAPTCHA_PNG)
+
+def image_response(image_bytes, etag, cache_control, mimetype='image/png'):
+    """ETag/Cache-Control付きで画像を返す（一致すれば304）"""
+    headers = {'ETag': etag, 'Cache-Control': cache_control}
+    if etag in request.headers.get('If-None-Match', ''):
+        return Response(status=304, headers=headers)
+    return Response(image_bytes, mimetype=mimetype, headers=headers)
+
 @app.route('/api/captcha/check', methods=['POST'])
 def check_client():
     """クライアントの初期チェック"""
-    client_ip = request.environ.get('HTTP_X_FORWARDED_FOR', request.remote_addr)
+    client_ip = get_client_ip()
     user_agent = request.headers.get('User-Agent', '')
     
     # IP/UAチェック
-    if is_suspicious_ip(client_ip) or is_suspicious_user_agent(user_agent):
+    if is_suspicious_client(client_ip, user_agent):
         return jsonify({
             'success': False,
             'message': 'アクセスが拒否されました',
@@ -117,38 +970,27 @@ def check_client():
 @app.route('/api/captcha', methods=['GET'])
 def generate_captcha():
     """CAPTCHA画像とセッションを生成"""
-    client_ip = request.environ.get('HTTP_X_FORWARDED_FOR', request.remote_addr)
+    client_ip = get_client_ip()
     user_agent = request.headers.get('User-Agent', '')
     
     # 再度チェック
-    if is_suspicious_ip(client_ip) or is_suspicious_user_agent(user_agent):
+    if is_suspicious_client(client_ip, user_agent):
         return jsonify({'error': 'Access denied'}), 403
     
-    # CAPTCHAテキスト生成
-    captcha_text = generate_captcha_text()
+    # 事前生成済みのCAPTCHAを取得
+    captcha_text, image_bytes = captcha_pool.get()
     
-    # セッションID生成
-    session_id = hashlib.md5(f"{client_ip}{user_agent}{time.time()}".encode()).hexdigest()
-    
-    # セッション保存
-    captcha_sessions[session_id] = {
-        'text': captcha_text,
-        'ip': client_ip,
-        'user_agent': user_agent,
-        'created_at': datetime.now(),
-        'verified': False
-    }
-    
-    # 期限切れセッション削除
-    cleanup_expired_sessions()
-    
-    # CAPTCHA画像生成
-    image = create_captcha_image(captcha_text)
-    
-    # 画像をbase64エンコード
-    img_buffer = io.BytesIO()
-    image.save(img_buffer, format='PNG')
-    img_buffer.seek(0)
+    if CAPTCHA_STATELESS:
+        # 答えはトークンに署名して持たせ、サーバーには何も保存しない
+        session_id = issue_captcha_token(captcha_text, client_ip, user_agent)
+    else:
+        # セッションID生成
+        session_id = hashlib.md5(f"{client_ip}{user_agent}{time.time()}".encode()).hexdigest()
+        
+        # セッション保存（期限切れセッションの削除も行われる）
+        captcha_sessions.add(session_id, CaptchaSession(
+            captcha_text, client_ip, user_agent, image_bytes, image_etag(image_bytes)
+        ))
     
     # 選択肢生成（正解 + ダミー4つ）
     choices = [captcha_text]
@@ -159,36 +1001,46 @@ def generate_captcha():
     
     random.shuffle(choices)
     
-    return jsonify({
+    response = {
         'session_id': session_id,
-        'image': base64.b64encode(img_buffer.getvalue()).decode(),
+        'image_type': IMAGE_MIMETYPES[CAPTCHA_IMAGE_FORMAT],
         'choices': choices
-    })
+    }
+    # URLで返すとbase64（約33%増）をJSONに含めずに済む（ステートレスモードは画像を保存しないのでinlineのみ）
+    delivery = request.args.get('image', CAPTCHA_IMAGE_DELIVERY)
+    if delivery == 'url' and not CAPTCHA_STATELESS:
+        response['image_url'] = f'/api/captcha/captcha.png?session={session_id}'
+    else:
+        response['image'] = base64.b64encode(image_bytes).decode()
+    return jsonify(response)
 
 @app.route('/api/captcha/captcha.png')
 def get_captcha_image():
-    """CAPTCHA画像を直接取得（画像URL用）"""
+    """CAPTCHA画像を直接取得（画像URL用、生成済みの画像を返す）"""
     session_id = request.args.get('session')
-    if not session_id or session_id not in captcha_sessions:
+    session = captcha_sessions.get(session_id) if session_id else None
+    if not session or session.is_expired():
         # デフォルト画像を返す
-        img = Image.new('RGB', (200, 80), color='lightgray')
-        draw = ImageDraw.Draw(img)
-        draw.text((50, 30), 'Invalid', fill='black')
-        
-        img_buffer = io.BytesIO()
-        img.save(img_buffer, format='PNG')
-        img_buffer.seek(0)
-        
-        return send_file(img_buffer, mimetype='image/png')
-    
-    session = captcha_sessions[session_id]
-    image = create_captcha_image(session['text'])
-    
-    img_buffer = io.BytesIO()
-    image.save(img_buffer, format='PNG')
-    img_buffer.seek(0)
+        return image_response(INVALID_CAPTCHA_PNG, INVALID_CAPTCHA_ETAG, 'public, max-age=86400')
     
-    return send_file(img_buffer, mimetype='image/png')
+    return image_response(session.image, session.etag, f'private, max-age={CAPTCHA_EXPIRE_TIME}',
+                          IMAGE_MIMETYPES[CAPTCHA_IMAGE_FORMAT])
+
+@app.route('/api/captcha/pool')
+def captcha_pool_stats():
+    """CAPTCHAプールのメトリクス"""
+    return jsonify(captcha_pool.stats())
+
+@app.route('/api/captcha/stats')
+def captcha_stats():
+    """CAPTCHAプールとセッションストアのメトリクス"""
+    return jsonify({
+        'pool': captcha_pool.stats(),
+        'sessions': captcha_sessions.stats(),
+        'stateless': CAPTCHA_STATELESS,
+        'replay_filter': replay_filter.stats(),
+        'rate_limit': rate_limiter.stats()
+    })
 
 @app.route('/api/captcha/verify', methods=['POST'])
 def verify_captcha():
@@ -197,35 +1049,37 @@ def verify_captcha():
     session_id = data.get('session_id')
     user_answer = data.get('answer')
     
-    if not session_id or session_id not in captcha_sessions:
+    if CAPTCHA_STATELESS:
+        return verify_captcha_token(session_id, user_answer)
+    
+    session = captcha_sessions.get(session_id) if session_id else None
+    if not session:
         return jsonify({
             'success': False,
             'message': 'セッションが無効です'
         }), 400
     
-    session = captcha_sessions[session_id]
-    
     # セッション有効期限チェック
-    if datetime.now() - session['created_at'] > timedelta(seconds=CAPTCHA_EXPIRE_TIME):
-        del captcha_sessions[session_id]
+    if session.is_expired():
+        captcha_sessions.pop(session_id)
         return jsonify({
             'success': False,
             'message': 'セッションが期限切れです'
         }), 400
     
     # IP/UAチェック
-    client_ip = request.environ.get('HTTP_X_FORWARDED_FOR', request.remote_addr)
+    client_ip = get_client_ip()
     user_agent = request.headers.get('User-Agent', '')
     
-    if session['ip'] != client_ip or session['user_agent'] != user_agent:
+    if session.ip != client_ip or session.user_agent != user_agent:
         return jsonify({
             'success': False,
             'message': '不正なアクセスです'
         }), 403
     
     # 回答チェック
-    if user_answer and user_answer.upper() == session['text'].upper():
-        session['verified'] = True
+    if user_answer and user_answer.upper() == session.text.upper():
+        captcha_sessions.mark_verified(session_id, session)
         return jsonify({
             'success': True,
             'message': '認証成功！',
@@ -237,19 +1091,57 @@ def verify_captcha():
             'message': '回答が間違っています'
         })
 
+def verify_captcha_token(token, user_answer):
+    """ステートレスモードのCAPTCHA認証（共有状態なしで署名付きトークンを検証）"""
+    payload = load_signed_token(token) if token else None
+    if not payload or not {'n', 'a', 'f', 'exp'} <= payload.keys():
+        return jsonify({
+            'success': False,
+            'message': 'セッションが無効です'
+        }), 400
+    
+    if payload['exp'] < time.time():
+        return jsonify({
+            'success': False,
+            'message': 'セッションが期限切れです'
+        }), 400
+    
+    # IP/UAチェック
+    client_ip = get_client_ip()
+    user_agent = request.headers.get('User-Agent', '')
+    
+    if not hmac.compare_digest(payload['f'], client_fingerprint(client_ip, user_agent)):
+        return jsonify({
+            'success': False,
+            'message': '不正なアクセスです'
+        }), 403
+    
+    # 回答は1トークンにつき1回だけ（選択肢の総当たりを防ぐ）
+    if not replay_filter.check_and_add(payload['n']):
+        return jsonify({
+            'success': False,
+            'message': 'このCAPTCHAは使用済みです'
+        }), 400
+    
+    if user_answer and hmac.compare_digest(payload['a'], answer_hash(payload['n'], user_answer)):
+        return jsonify({
+            'success': True,
+            'message': '認証成功！',
+            'token': generate_verification_token(payload['n'])
+        })
+    else:
+        return jsonify({
+            'success': False,
+            'message': '回答が間違っています'
+        })
+
 def generate_verification_token(session_id):
-    """認証トークン生成"""
-    return hashlib.sha256(f"{session_id}verified{time.time()}".encode()).hexdigest()
-
-def cleanup_expired_sessions():
-    """期限切れセッションを削除"""
-    now = datetime.now()
-    expired_sessions = [
-        sid for sid, session in captcha_sessions.items()
-        if now - session['created_at'] > timedelta(seconds=CAPTCHA_EXPIRE_TIME)
-    ]
-    for sid in expired_sessions:
-        del captcha_sessions[sid]
+    """認証トークン生成（署名付きなので load_signed_token で検証できる）"""
+    return sign_token({
+        'sub': session_id,
+        'verified': True,
+        'exp': int(time.time()) + CAPTCHA_EXPIRE_TIME
+    })
 
 @app.route('/demo')
 def demo_page():
@@ -331,7 +1223,8 @@ def demo_page():
                 .then(response => response.json())
                 .then(data => {
                     currentSession = data.session_id;
-                    document.getElementById('captchaImage').src = 'data:image/png;base64,' + data.image;
+                    document.getElementById('captchaImage').src = data.image_url ||
+                        'data:' + data.image_type + ';base64,' + data.image;
                     
                     const choicesDiv = document.getElementById('choices');
                     choicesDiv.innerHTML = '';
@@ -182,26 +182,9 @@ def download_file(id):
     file_path = info["path"]
     original_filename = info.get("original_filename", "video.mp4")
     
-    # ファイル存在確認
+    # ファイル存在確認（パスはダウンロード時にyt-dlpが報告した正確なもの）
     if not os.path.exists(file_path):
-        # 拡張子違いのファイルを探す
-        base_path = os.path.splitext(file_path)[0]
-        extensions = ["mp4", "webm", "mp3", "m4a", "mkv", "avi"]
-        
-        found_file = None
-        for ext in extensions:
-            alt_path = f"{base_path}.{ext}"
-            if os.path.exists(alt_path):
-                found_file = alt_path
-                # 元のファイル名の拡張子も更新
-                base_name = os.path.splitext(original_filename)[0]
-                original_filename = f"{base_name}.{ext}"
-                break
-        
-        if not found_file:
-            return render_template("error.html", error="ファイルが見つかりませんでした。")
-        
-        file_path = found_file
+        return render_template("error.html", error="ファイルが見つかりませんでした。")
 
     try:
         return send_file(file_path, 
@@ -300,10 +283,16 @@ def download_video_safe(link, output_path, format_opt, is_audio=False):
     """安全にダウンロード実行"""
     # 一時ファイルパスを生成（拡張子なしのベース名）
     temp_base = os.path.join(TEMP_FOLDER, f"temp_{int(time.time())}_{os.path.splitext(os.path.basename(output_path))[0]}")
+    touched_files = set()  # 失敗時に削除するファイル
+    
+    def track_files(d):
+        for key in ('filename', 'tmpfilename'):
+            if d.get(key):
+                touched_files.add(d[key])
     
     ydl_opts = {
         'format': format_opt,
-        'outtmpl': f'{temp_base}.%(ext)s',  # yt-dlpに拡張子を決定させる
+        'outtmpl': temp_base.replace('%', '%%') + '.%(ext)s',  # yt-dlpに拡張子を決定させる
         'quiet': True,
         'no_warnings': True,
         'continuedl': True,
@@ -313,6 +302,7 @@ def download_video_safe(link, output_path, format_opt, is_audio=False):
         'writeinfojson': False,
         'writesubtitles': False,
         'writeautomaticsub': False,
+        'progress_hooks': [track_files],
     }
     
     # 音声の場合の追加設定
@@ -327,28 +317,11 @@ def download_video_safe(link, output_path, format_opt, is_audio=False):
     
     try:
         with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            ydl.download([link])
+            result = ydl.extract_info(link, download=True)
         
-        # ダウンロードされたファイルを探す
-        temp_dir = os.path.dirname(temp_base)
-        temp_basename = os.path.basename(temp_base)
-        
-        actual_file = None
-        # temp_baseで始まるファイルを全て探す
-        for filename in os.listdir(temp_dir):
-            if filename.startswith(temp_basename):
-                actual_file = os.path.join(temp_dir, filename)
-                logger.info(f"見つかったファイル: {actual_file}")
-                break
-        
-        # 見つからない場合は拡張子を試す
-        if not actual_file:
-            possible_extensions = ['mp4', 'webm', 'mp3', 'm4a', 'mkv'] if not is_audio else ['mp3', 'm4a']
-            for ext in possible_extensions:
-                test_path = f"{temp_base}.{ext}"
-                if os.path.exists(test_path):
-                    actual_file = test_path
-                    break
+        # yt-dlpが報告した最終ファイルパスを使う（ディレクトリは走査しない）
+        downloads = result.get('requested_downloads') or []
+        actual_file = downloads[-1].get('filepath') if downloads else result.get('filepath')
         
         if actual_file and os.path.exists(actual_file):
             file_size = os.path.getsize(actual_file)
@@ -369,23 +342,16 @@ def download_video_safe(link, output_path, format_opt, is_audio=False):
             logger.info(f"ダウンロード完了: {final_output} ({file_size} bytes)")
             return final_output
         else:
-            # デバッグ情報
-            temp_files = [f for f in os.listdir(temp_dir) if temp_basename in f]
-            logger.error(f"ファイルが見つからない. temp_base: {temp_base}, 一時ファイル一覧: {temp_files}")
+            logger.error(f"ファイルが見つからない. temp_base: {temp_base}, 報告されたパス: {actual_file}")
             raise Exception("ダウンロードされたファイルが見つかりません")
             
     except Exception as e:
-        # 一時ファイルのクリーンアップ
-        temp_dir = os.path.dirname(temp_base)
-        temp_basename = os.path.basename(temp_base)
-        
+        # 一時ファイルのクリーンアップ（進捗フックで報告されたファイルのみ）
         try:
-            for filename in os.listdir(temp_dir):
-                if filename.startswith(temp_basename):
-                    cleanup_path = os.path.join(temp_dir, filename)
-                    if os.path.exists(cleanup_path):
-                        os.remove(cleanup_path)
-                        logger.info(f"クリーンアップ: {cleanup_path}")
+            for cleanup_path in touched_files:
+                if os.path.exists(cleanup_path):
+                    os.remove(cleanup_path)
+                    logger.info(f"クリーンアップ: {cleanup_path}")
         except Exception as cleanup_error:
             logger.error(f"クリーンアップエラー: {cleanup_error}")
         
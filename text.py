@@ -1,11 +1,29 @@
 import os, time, threading, base64, hashlib, re
-from flask import Flask, render_template, send_file, abort, jsonify, request
+import asyncio
+import copy
+import heapq
+import itertools
+import multiprocessing
+import queue
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from flask import Flask, Response, render_template, jsonify, request
 from discord import app_commands, Intents, Client, Interaction
 import yt_dlp
 import discord
-from urllib.parse import urlparse
+from urllib.parse import quote
 import logging
 import json
+import sqlite3
+
+# ASGIモード用（任意）
+try:
+    from starlette.applications import Starlette
+    from starlette.responses import HTMLResponse, JSONResponse, Response as ASGIResponse, StreamingResponse
+    from starlette.routing import Route
+    import uvicorn
+except ImportError:
+    Starlette = None
 
 # === ログ設定 ===
 logging.basicConfig(level=logging.INFO)
@@ -15,8 +33,25 @@ logger = logging.getLogger(__name__)
 TOKEN = os.getenv("DISCORD_TOKEN", "")  # 環境変数から取得
 BASE_URL = os.getenv("BASE_URL", "https://ec5a407eeded-5005-shironekousercontent.paicha.dev:5005")
 PORT = int(os.getenv("PORT", 5000))
+SERVER_MODE = os.getenv("SERVER_MODE", "flask")  # flask: 開発サーバーを別スレッド / asgi: Botと同じイベントループ
 DOWNLOAD_FOLDER = "downloads"
 TEMP_FOLDER = "temp"
+DOWNLOAD_TTL = 3600  # ダウンロードリンクの有効期限（秒）
+INDEX_PATH = os.getenv("DOWNLOAD_INDEX", "downloads.sqlite3")  # ダウンロード情報の永続化先
+SENDFILE_MODE = os.getenv("SENDFILE_MODE", "")  # 空: アプリから送信 / x-accel: nginx / x-sendfile: Apache等
+X_ACCEL_PREFIX = os.getenv("X_ACCEL_PREFIX", "/protected-downloads/")  # nginxのinternal location
+ORPHAN_FILE_TTL = 7200  # 管理外ファイルを削除するまでの時間（秒）
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", 2))  # 同時ダウンロード数
+JOB_QUEUE_SIZE = int(os.getenv("JOB_QUEUE_SIZE", 50))  # 待機できるジョブ数の上限
+JOB_EXECUTOR = os.getenv("JOB_EXECUTOR", "thread")  # thread または process
+JOB_RESULT_TTL = 600  # 失敗したジョブ情報の保持時間（秒）
+METADATA_CACHE_SIZE = 256  # 動画情報キャッシュの最大件数
+METADATA_CACHE_TTL = 1800  # 動画情報キャッシュの有効期間（秒、配信URLの期限より短く）
+BOT_DOWNLOAD_WORKERS = int(os.getenv("BOT_DOWNLOAD_WORKERS", 3))  # Botの同時ダウンロード数
+PROGRESS_UPDATE_INTERVAL = 3  # 進捗メッセージの更新間隔（秒）
+PROGRESS_PUBLISH_INTERVAL = 0.5  # SSEへの進捗配信間隔（秒）
+SSE_KEEPALIVE_INTERVAL = 15  # SSEのkeep-alive送信間隔（秒）
+PROGRESS_CHANNEL_TTL = 60  # 完了後に進捗チャンネルを残す時間（秒）
 
 # フォルダ作成
 os.makedirs(DOWNLOAD_FOLDER, exist_ok=True)
@@ -52,88 +87,520 @@ def get_safe_filename(info, file_id, is_audio=False):
     ext = 'mp3' if is_audio else 'mp4'
     return f"{file_id}_{title}.{ext}"
 
+# === 期限切れスケジューラー ===
+class ExpiryScheduler:
+    """期限付きの処理をmin-heapで管理し、1スレッドで順番に実行する"""
+
+    def __init__(self):
+        self._heap = []  # (実行時刻, 連番, 関数, 引数)
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+        self.executed = 0
+
+    def call_at(self, when, func, *args):
+        """指定時刻(time.time基準)に func(*args) を実行するよう予約"""
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="expiry-scheduler", daemon=True)
+                self._thread.start()
+            heapq.heappush(self._heap, (when, next(self._counter), func, args))
+            # 先頭が変わった場合のみ待機中のスレッドを起こす
+            if self._heap[0][0] == when:
+                self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._heap:
+                    self._cond.wait()
+                delay = self._heap[0][0] - time.time()
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+                _, _, func, args = heapq.heappop(self._heap)
+                self.executed += 1
+
+            try:
+                func(*args)
+            except Exception as e:
+                logger.error(f"期限切れ処理エラー: {e}")
+
+    def stats(self):
+        """メトリクス（待機件数・次回実行までの秒数・実行済み件数）"""
+        with self._cond:
+            next_due = self._heap[0][0] - time.time() if self._heap else None
+            return {
+                "pending": len(self._heap),
+                "next_due_in": round(max(next_due, 0), 1) if next_due is not None else None,
+                "executed": self.executed
+            }
+
+expiry_scheduler = ExpiryScheduler()
+
+# === ダウンロード情報の永続化 ===
+class DownloadIndex:
+    """download_info をSQLiteに書き込み、再起動後も復元できるようにする"""
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS downloads ("
+            "id TEXT PRIMARY KEY, path TEXT NOT NULL, expire REAL NOT NULL, "
+            "title TEXT, thumbnail TEXT, original_filename TEXT, etag TEXT)"
+        )
+        # 旧バージョンのテーブルにはetag列がない
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(downloads)")]
+        if "etag" not in columns:
+            self._conn.execute("ALTER TABLE downloads ADD COLUMN etag TEXT")
+        self._conn.commit()
+
+    def put(self, file_id, info):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO downloads "
+                "(id, path, expire, title, thumbnail, original_filename, etag) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (file_id, info["path"], info["expire"], info.get("title"),
+                 info.get("thumbnail"), info.get("original_filename"), info.get("etag"))
+            )
+
+    def touch(self, file_id, expire):
+        with self._lock, self._conn:
+            self._conn.execute("UPDATE downloads SET expire = ? WHERE id = ?", (expire, file_id))
+
+    def remove(self, file_id):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM downloads WHERE id = ?", (file_id,))
+
+    def load(self):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, path, expire, title, thumbnail, original_filename, etag FROM downloads"
+            ).fetchall()
+        return {
+            row[0]: {
+                'path': row[1],
+                'expire': row[2],
+                'title': row[3],
+                'thumbnail': row[4],
+                'original_filename': row[5],
+                'etag': row[6]
+            }
+            for row in rows
+        }
+
+download_index = DownloadIndex(INDEX_PATH)
+
+def restore_downloads():
+    """起動時に永続化したダウンロード情報を読み込み、期限切れ処理を再登録"""
+    now = time.time()
+    restored = 0
+    for file_id, info in download_index.load().items():
+        if info["expire"] <= now or not os.path.exists(info["path"]):
+            download_info[file_id] = info
+            cleanup_file(file_id)
+            continue
+        download_info[file_id] = info
+        expiry_scheduler.call_at(info["expire"], cleanup_file, file_id)
+        restored += 1
+    logger.info(f"ダウンロード情報を復元: {restored}件")
+
+# === ジョブ管理 ===
+jobs = {}  # id: {status, url, fmt, is_audio, title, error, created_at}
+job_queue = deque()  # 待機中のジョブID（先頭から順に実行）
+job_cond = threading.Condition()
+job_workers = []
+job_executor = None
+job_progress_manager = None  # プロセスモードで子プロセスの進捗を受け取るManager
+async_download_manager = None  # ASGIモードではイベントループ上で実行
+
+def start_job_executor():
+    """プロセスモードのExecutorを起動時に作成（forkはスレッド起動後だとデッドロックし得るのでspawn）"""
+    global job_executor, job_progress_manager
+    if JOB_EXECUTOR != "process" or job_executor is not None:
+        return
+    context = multiprocessing.get_context("spawn")
+    job_executor = ProcessPoolExecutor(max_workers=JOB_WORKERS, mp_context=context)
+    job_progress_manager = context.Manager()
+
+def ensure_job_workers():
+    """ワーカースレッドを必要に応じて起動"""
+    with job_cond:
+        if job_workers or async_download_manager is not None:
+            return
+        start_job_executor()
+        for i in range(JOB_WORKERS):
+            worker = threading.Thread(target=job_worker, name=f"job-worker-{i}", daemon=True)
+            worker.start()
+            job_workers.append(worker)
+        logger.info(f"ジョブワーカー起動: {JOB_WORKERS}個 ({JOB_EXECUTOR})")
+
+def submit_job(job_id, url, fmt, is_audio):
+    """ジョブをキューに登録（キューが満杯ならNone）"""
+    ensure_job_workers()
+    with job_cond:
+        job = jobs.get(job_id)
+        if job and job["status"] in ("queued", "running"):
+            return job
+        if len(job_queue) >= JOB_QUEUE_SIZE:
+            return None
+        job = {
+            'status': 'queued',
+            'url': url,
+            'fmt': fmt,
+            'is_audio': is_audio,
+            'title': None,
+            'error': None,
+            'created_at': time.time()
+        }
+        jobs[job_id] = job
+        job_queue.append(job_id)
+        progress_channels[job_id] = JobProgress()
+        progress_channels[job_id].publish(status="queued", queue_position=len(job_queue))
+        job_cond.notify()
+        if async_download_manager is not None:
+            async_download_manager.notify()
+        return job
+
+def get_queue_position(job_id):
+    """キュー内の順番（1始まり、待機中でなければNone）"""
+    with job_cond:
+        try:
+            return job_queue.index(job_id) + 1
+        except ValueError:
+            return None
+
+def job_worker():
+    """キューからジョブを取り出して実行"""
+    while True:
+        with job_cond:
+            while not job_queue:
+                job_cond.wait()
+            job_id = take_next_job()
+        run_job(job_id)
+
+def take_next_job():
+    """先頭のジョブを実行中にして返す（job_condを保持して呼ぶ）"""
+    job_id = job_queue.popleft()
+    jobs[job_id]['status'] = 'running'
+    # 待機中ジョブの順番を更新
+    for position, queued_id in enumerate(job_queue, 1):
+        progress_channels[queued_id].publish(queue_position=position)
+    return job_id
+
+def run_job(job_id):
+    """ジョブを実行し、結果をジョブ情報と進捗チャンネルに反映"""
+    job = jobs[job_id]
+    channel = progress_channels[job_id]
+    channel.publish(status="running", queue_position=None)
+    try:
+        ensure_download(job_id, job['url'], job['fmt'], job['is_audio'],
+                        progress_hook=make_job_progress_hook(channel), executor=job_executor)
+    except Exception as e:
+        logger.error(f"ジョブ失敗 {job_id}: {e}")
+        with job_cond:
+            job['status'] = 'failed'
+            job['error'] = str(e)[:200]
+        channel.finish(status="failed", error=job['error'])
+        expiry_scheduler.call_at(time.time() + JOB_RESULT_TTL, discard_job, job_id, job)
+        expiry_scheduler.call_at(time.time() + PROGRESS_CHANNEL_TTL, discard_progress_channel, job_id, channel)
+        return
+
+    with job_cond:
+        jobs.pop(job_id, None)
+    channel.finish(**get_status_payload(job_id))
+    expiry_scheduler.call_at(time.time() + PROGRESS_CHANNEL_TTL, discard_progress_channel, job_id, channel)
+
+# === 進捗配信 ===
+class JobProgress:
+    """1ジョブの最新進捗を保持し、待機中の全クライアントへ通知する"""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._async_waiters = []  # (イベントループ, Future)
+        self.version = 0
+        self.state = {"status": "queued"}
+
+    def publish(self, **fields):
+        """進行中の状態を更新（既存の項目に上書きでマージ）"""
+        self._set(fields, merge=True)
+
+    def finish(self, **fields):
+        """終了状態を送る（進行中の percent や phase を引き継がないよう丸ごと置き換える）"""
+        self._set(fields, merge=False)
+
+    def _set(self, fields, merge):
+        with self._cond:
+            self.state = {**self.state, **fields} if merge else fields
+            self.version += 1
+            self._cond.notify_all()
+            waiters, self._async_waiters = self._async_waiters, []
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(_resolve_future, future)
+
+    def wait(self, version, timeout):
+        """versionより新しい状態を待つ（タイムアウト時はstateがNone）"""
+        with self._cond:
+            if self.version == version:
+                self._cond.wait(timeout)
+            if self.version == version:
+                return version, None
+            return self.version, dict(self.state)
+
+    async def wait_async(self, version, timeout):
+        """waitのasync版（スレッドを占有せずイベントループ上で待つ）"""
+        with self._cond:
+            if self.version == version:
+                future = asyncio.get_running_loop().create_future()
+                self._async_waiters.append((asyncio.get_running_loop(), future))
+            else:
+                future = None
+        if future is not None:
+            try:
+                await asyncio.wait_for(future, timeout)
+            except asyncio.TimeoutError:
+                with self._cond:
+                    self._async_waiters = [w for w in self._async_waiters if w[1] is not future]
+        with self._cond:
+            if self.version == version:
+                return version, None
+            return self.version, dict(self.state)
+
+def _resolve_future(future):
+    if not future.done():
+        future.set_result(None)
+
+progress_channels = {}  # id: JobProgress
+ACTIVE_JOB_STATUSES = ("queued", "running")  # これ以外の状態が届いたらSSEを終える
+
+def discard_progress_channel(job_id, channel):
+    """完了したジョブの進捗チャンネルを削除"""
+    if progress_channels.get(job_id) is channel:
+        del progress_channels[job_id]
+
+def make_job_progress_hook(channel):
+    """yt-dlpの進捗・後処理フックをJobProgressへの配信に変換"""
+    last_publish = [0.0]
+
+    def hook(d):
+        if 'postprocessor' in d:
+            if d.get('status') == 'started':
+                channel.publish(status="running", phase="postprocessing", postprocessor=d['postprocessor'])
+            return
+        now = time.time()
+        if d.get('status') != 'downloading' or now - last_publish[0] < PROGRESS_PUBLISH_INTERVAL:
+            return
+        last_publish[0] = now
+
+        total = d.get('total_bytes') or d.get('total_bytes_estimate')
+        channel.publish(
+            status="running",
+            phase="downloading",
+            title=d.get('info_dict', {}).get('title'),
+            percent=round(d.get('downloaded_bytes', 0) / total * 100, 1) if total else None,
+            speed=d.get('speed'),
+            eta=d.get('eta')
+        )
+
+    return hook
+
+# === ダウンロードキャッシュ ===
+inflight = {}  # id: Future（処理中のダウンロード）
+inflight_lock = threading.Lock()
+
+def get_cached_download(file_id):
+    """有効なダウンロード済みファイルがあれば期限を延長して返す"""
+    info = download_info.get(file_id)
+    if not info or time.time() > info["expire"] or not os.path.exists(info["path"]):
+        return None
+    info["expire"] = max(info["expire"], time.time() + DOWNLOAD_TTL)
+    download_index.touch(file_id, info["expire"])
+    return info
+
+def ensure_download(file_id, url, fmt, is_audio, progress_hook=None, executor=None):
+    """キャッシュを返すか、同じIDの処理中ダウンロードを待つ（single-flight）"""
+    with inflight_lock:
+        cached = get_cached_download(file_id)
+        if cached:
+            return cached
+        future = inflight.get(file_id)
+        is_leader = future is None
+        if is_leader:
+            future = inflight[file_id] = Future()
+
+    if not is_leader:
+        logger.info(f"処理中のダウンロードを待機: {file_id}")
+        return future.result()
+
+    try:
+        if executor is not None:
+            result = run_download_in_process(executor, url, fmt, is_audio, file_id, progress_hook)
+        else:
+            result = perform_download(url, fmt, is_audio, file_id, progress_hook)
+        entry = register_download(file_id, result['path'], result['title'], result['thumbnail'])
+        future.set_result(entry)
+        return entry
+    except Exception as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with inflight_lock:
+            inflight.pop(file_id, None)
+
+def run_download_in_process(executor, url, fmt, is_audio, file_id, progress_hook=None):
+    """子プロセスでダウンロードし、進捗はManagerのキュー経由でprogress_hookへ中継"""
+    if progress_hook is None or job_progress_manager is None:
+        return executor.submit(perform_download, url, fmt, is_audio, file_id).result()
+
+    progress_queue = job_progress_manager.Queue()
+    future = executor.submit(perform_download_with_queue, url, fmt, is_audio, file_id, progress_queue)
+    while True:
+        done = future.done()
+        try:
+            while True:
+                progress_hook(progress_queue.get(timeout=0 if done else 0.2))
+        except queue.Empty:
+            pass
+        if done:
+            return future.result()
+
+def perform_download_with_queue(url, fmt, is_audio, file_id, progress_queue):
+    """子プロセス側: yt-dlpのフック引数から必要な項目だけをキューへ送る"""
+    last_put = [0.0]
+
+    def hook(d):
+        now = time.time()
+        if 'postprocessor' not in d and d.get('status') == 'downloading':
+            if now - last_put[0] < PROGRESS_PUBLISH_INTERVAL:
+                return
+            last_put[0] = now
+        item = {key: d[key] for key in ('status', 'postprocessor', 'downloaded_bytes', 'total_bytes',
+                                        'total_bytes_estimate', 'speed', 'eta') if key in d}
+        item['info_dict'] = {'title': d.get('info_dict', {}).get('title')}
+        progress_queue.put(item)
+
+    return perform_download(url, fmt, is_audio, file_id, hook)
+
+def discard_job(job_id, job):
+    """失敗したジョブ情報を削除（同じIDで再登録されたジョブは残す）"""
+    with job_cond:
+        if jobs.get(job_id) is job:
+            del jobs[job_id]
+
+def perform_download(url, fmt, is_audio, file_id, progress_hook=None):
+    """動画情報取得からダウンロードまでを実行（ワーカー用）"""
+    info = get_video_info(url)
+    if not info:
+        raise Exception("動画情報を取得できませんでした")
+
+    safe_filename = get_safe_filename(info, file_id, is_audio)
+    output_path = os.path.join(DOWNLOAD_FOLDER, safe_filename)
+    # 取得済みの動画情報をそのまま使ってダウンロード（再抽出しない）
+    final_path = download_video_safe(url, output_path, fmt, is_audio, progress_hook, info=info)
+    return {
+        'path': final_path,
+        'title': info.get("title", "Unknown Video"),
+        'thumbnail': info.get("thumbnail")
+    }
+
+def register_download(file_id, final_path, title, thumbnail):
+    """ダウンロード情報を保存して期限切れ削除を予約"""
+    download_info[file_id] = {
+        'path': final_path,
+        'expire': time.time() + DOWNLOAD_TTL,  # 1時間後に期限切れ
+        'title': title,
+        'thumbnail': thumbnail,
+        'original_filename': os.path.basename(final_path),
+        'etag': file_sha256(final_path)[:32]  # ワーカー側で一度だけ計算
+    }
+
+    download_index.put(file_id, download_info[file_id])
+
+    # 1時間後にクリーンアップをスケジュール
+    expiry_scheduler.call_at(download_info[file_id]['expire'], cleanup_file, file_id)
+    return download_info[file_id]
+
 # === API エンドポイント追加 ===
 @app.route("/api/download", methods=["POST"])
 def api_download():
-    """YouTube動画ダウンロードAPI"""
+    """YouTube動画ダウンロードAPI（ジョブを登録してIDを即時返却）"""
+    payload, status, headers = create_download_job(request.get_json(silent=True))
+    return jsonify(payload), status, headers
+
+def create_download_job(data):
+    """リクエストを検証してジョブを登録（Flask/ASGI共通、(payload, status, headers)を返す）"""
     try:
-        # JSON データを取得
-        data = request.get_json()
+        # JSON データを確認
         if not data:
-            return jsonify({"error": "JSONデータが必要です"}), 400
+            return {"error": "JSONデータが必要です"}, 400, {}
         
         url = data.get("url")
         format_type = data.get("format", "mp4")  # mp4 または mp3
         
         if not url:
-            return jsonify({"error": "URLが必要です"}), 400
+            return {"error": "URLが必要です"}, 400, {}
         
         # URL妥当性チェック
         if not is_valid_youtube_url(url):
-            return jsonify({"error": "有効なYouTube URLではありません"}), 400
-        
-        # 動画情報取得
-        info = extract_info_safe(url)
-        if not info:
-            return jsonify({"error": "動画情報を取得できませんでした"}), 400
+            return {"error": "有効なYouTube URLではありません"}, 400, {}
         
         # ダウンロード設定
         is_audio = format_type.lower() == "mp3"
         fmt = "bestaudio/best" if is_audio else "best[ext=mp4]/best"
         
-        # ID生成とファイルパス設定
-        file_id = generate_id(url, fmt)
-        title = info.get("title", "Unknown Video")
-        safe_filename = get_safe_filename(info, file_id, is_audio)
-        output_path = os.path.join(DOWNLOAD_FOLDER, safe_filename)
-        
-        # ダウンロード実行
-        try:
-            final_path = download_video_safe(url, output_path, fmt, is_audio)
-        except Exception as e:
-            return jsonify({"error": f"ダウンロード失敗: {str(e)}"}), 500
-        
-        # ダウンロード情報を保存
-        download_info[file_id] = {
-            'path': final_path,
-            'expire': time.time() + 3600,  # 1時間後に期限切れ
-            'title': title,
-            'thumbnail': info.get("thumbnail"),
-            'original_filename': os.path.basename(final_path)
-        }
-        
-        # 1時間後にクリーンアップをスケジュール
-        threading.Timer(3600, cleanup_file, args=(file_id,)).start()
+        # キャッシュ済みなら即時返却
+        job_id = generate_id(url, fmt)
+        cached = get_cached_download(job_id)
+        if cached:
+            return {
+                "success": True,
+                "id": job_id,
+                "status": "ready",
+                "title": cached.get("title"),
+                "thumbnail": cached.get("thumbnail"),
+                "status_url": f"{BASE_URL}/api/status/{job_id}",
+                "download_page": f"{BASE_URL}/video/{job_id}",
+                "direct_download": f"{BASE_URL}/download/{job_id}",
+                "format": format_type,
+                "expires_at": int(cached["expire"]),
+                "filename": cached.get("original_filename")
+            }, 200, {}
         
-        # 成功レスポンス
-        download_url = f"{BASE_URL}/video/{file_id}"
-        direct_download_url = f"{BASE_URL}/download/{file_id}"
+        # ジョブ登録
+        job = submit_job(job_id, url, fmt, is_audio)
+        if job is None:
+            return {"error": "サーバーが混雑しています。しばらくしてから再試行してください"}, 503, {"Retry-After": "30"}
         
-        return jsonify({
+        return {
             "success": True,
-            "id": file_id,
-            "title": title,
-            "thumbnail": info.get("thumbnail"),
-            "download_page": download_url,
-            "direct_download": direct_download_url,
-            "format": format_type,
-            "expires_at": int(time.time() + 3600),
-            "filename": os.path.basename(final_path)
-        })
+            "id": job_id,
+            "status": job["status"],
+            "queue_position": get_queue_position(job_id),
+            "status_url": f"{BASE_URL}/api/status/{job_id}",
+            "download_page": f"{BASE_URL}/video/{job_id}",
+            "direct_download": f"{BASE_URL}/download/{job_id}",
+            "format": format_type
+        }, 202, {}
         
     except Exception as e:
         logger.error(f"API エラー: {e}")
-        return jsonify({"error": "内部サーバーエラー"}), 500
+        return {"error": "内部サーバーエラー"}, 500, {}
 
 # === API情報エンドポイント ===
 @app.route("/api/info", methods=["GET"])
 def api_info():
     """API使用方法の情報"""
-    return jsonify({
+    return jsonify(get_api_info())
+
+def get_api_info():
+    return {
         "api_version": "1.0",
         "endpoints": {
             "POST /api/download": {
-                "description": "YouTube動画をダウンロード",
+                "description": "YouTube動画のダウンロードジョブを登録（ジョブIDを即時返却）",
                 "parameters": {
                     "url": "YouTube動画のURL（必須）",
                     "format": "mp4 または mp3（デフォルト: mp4）"
@@ -143,16 +610,22 @@ def api_info():
                     "format": "mp4"
                 }
             },
+            "GET /api/progress/<id>": {
+                "description": "ジョブ進捗をServer-Sent Eventsで配信（percent/speed/eta/phase）"
+            },
+            "GET /api/stats": {
+                "description": "ジョブキューと期限切れ処理のメトリクス"
+            },
             "GET /api/status/<id>": {
                 "description": "ダウンロード状況を確認",
-                "response": "ready/processing/expired/not_found"
+                "response": "queued/running/ready/failed/expired/not_found（queuedの場合はqueue_positionを含む）"
             }
         },
         "curl_examples": [
             "curl -X POST -H 'Content-Type: application/json' -d '{\"url\":\"https://www.youtube.com/watch?v=dQw4w9WgXcQ\",\"format\":\"mp4\"}' http://localhost:5000/api/download",
             "curl -X POST -H 'Content-Type: application/json' -d '{\"url\":\"https://www.youtube.com/watch?v=dQw4w9WgXcQ\",\"format\":\"mp3\"}' http://localhost:5000/api/download"
         ]
-    })
+    }
 
 @app.route("/")
 def index():
@@ -160,77 +633,268 @@ def index():
 
 @app.route("/video/<id>")
 def video_page(id):
+    template, context = get_video_page(id)
+    return render_template(template, **context)
+
+def get_video_page(id):
+    """ダウンロードページのテンプレートと値（Flask/ASGI共通）"""
     info = download_info.get(id)
-    if not info or time.time() > info["expire"]:
-        return render_template("error.html", error="指定されたIDは存在しないか、有効期限が切れています。")
+    if not info:
+        # 処理中のジョブならステータス確認用にページを表示
+        job = jobs.get(id)
+        if job and job["status"] in ("queued", "running"):
+            info = {"title": job.get("title") or "処理中...", "thumbnail": None, "original_filename": "video"}
+    if not info or time.time() > info.get("expire", float("inf")):
+        return "error.html", {"error": "指定されたIDは存在しないか、有効期限が切れています。"}
     
-    return render_template("download.html", 
-                         id=id, 
-                         title=info.get("title", "Unknown"),
-                         thumbnail=info.get("thumbnail"),
-                         original_filename=info.get("original_filename", "video"))
+    return "download.html", {
+        "id": id,
+        "title": info.get("title", "Unknown"),
+        "thumbnail": info.get("thumbnail"),
+        "original_filename": info.get("original_filename", "video")
+    }
 
 @app.route("/download/<id>")
 def download_file(id):
+    info, error = resolve_download(id)
+    if error:
+        return render_template("error.html", error=error)
+
+    try:
+        return send_download(info["path"], info["etag"], info.get("original_filename", "video.mp4"),
+                             inline=request.args.get("inline") == "1")
+    except Exception as e:
+        logger.error(f"ファイル送信エラー: {e}")
+        return render_template("error.html", error="ファイルの送信中にエラーが発生しました。")
+
+def resolve_download(id):
+    """送信するダウンロード情報を取得（(info, None) または (None, エラーメッセージ)）"""
     info = download_info.get(id)
     if not info:
-        return render_template("error.html", error="指定されたIDは存在しません。")
+        return None, "指定されたIDは存在しません。"
 
     if time.time() > info["expire"]:
-        return render_template("error.html", error="このダウンロードリンクは有効期限が切れています。")
+        return None, "このダウンロードリンクは有効期限が切れています。"
 
-    file_path = info["path"]
-    original_filename = info.get("original_filename", "video.mp4")
-    
-    # ファイル存在確認
-    if not os.path.exists(file_path):
-        # 拡張子違いのファイルを探す
-        base_path = os.path.splitext(file_path)[0]
-        extensions = ["mp4", "webm", "mp3", "m4a", "mkv", "avi"]
-        
-        found_file = None
-        for ext in extensions:
-            alt_path = f"{base_path}.{ext}"
-            if os.path.exists(alt_path):
-                found_file = alt_path
-                # 元のファイル名の拡張子も更新
-                base_name = os.path.splitext(original_filename)[0]
-                original_filename = f"{base_name}.{ext}"
+    # ファイル存在確認（パスはダウンロード時にyt-dlpが報告した正確なもの）
+    if not os.path.exists(info["path"]):
+        return None, "ファイルが見つかりませんでした。"
+
+    if not info.get("etag"):
+        info["etag"] = file_sha256(info["path"])[:32]
+        download_index.put(id, info)
+    return info, None
+
+# === ファイル送信（Range / ETag / sendfile） ===
+MIME_TYPES = {
+    ".mp4": "video/mp4",
+    ".webm": "video/webm",
+    ".mkv": "video/x-matroska",
+    ".avi": "video/x-msvideo",
+    ".mp3": "audio/mpeg",
+    ".m4a": "audio/mp4",
+}
+SEND_CHUNK_SIZE = 1024 * 1024
+
+def file_sha256(path):
+    """ファイル内容のSHA-256（ETag用）"""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(SEND_CHUNK_SIZE), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def parse_range(header, size):
+    """Rangeヘッダーを解析（単一範囲のみ）。無視する場合None、範囲外なら(None, None)"""
+    match = re.fullmatch(r"bytes=(\d*)-(\d*)", header.strip())
+    if not match or match.groups() == ("", ""):
+        return None
+    start, end = match.groups()
+    if start == "":
+        # 末尾からNバイト
+        length = int(end)
+        if length == 0:
+            return (None, None)
+        start, end = max(size - length, 0), size - 1
+    else:
+        start = int(start)
+        if end and int(end) < start:
+            return None  # 終了位置が開始位置より前の指定は不正なので無視する（RFC 9110 14.1.1）
+        end = min(int(end), size - 1) if end else size - 1
+    if start >= size:
+        return (None, None)
+    return (start, end)
+
+def etag_matches(header, etag):
+    """If-None-Match の値がETagと一致するか（弱い比較）"""
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    return any(tag.strip().removeprefix("W/") == etag for tag in header.split(","))
+
+def if_range_matches(header, etag):
+    """If-Range の値がETagと一致するか（強い比較なので W/ 付きは常に不一致、日付指定も不一致扱い）"""
+    return header.strip() == etag
+
+class FileRangeIterator:
+    """ファイルの指定範囲をチャンクで返す（サーバーにsendfileがない場合用）"""
+
+    def __init__(self, f, length):
+        self.f = f
+        self.remaining = length
+
+    def __iter__(self):
+        while self.remaining > 0:
+            chunk = self.f.read(min(SEND_CHUNK_SIZE, self.remaining))
+            if not chunk:
                 break
-        
-        if not found_file:
-            return render_template("error.html", error="ファイルが見つかりませんでした。")
-        
-        file_path = found_file
+            self.remaining -= len(chunk)
+            yield chunk
 
-    try:
-        return send_file(file_path, 
-                        as_attachment=True, 
-                        download_name=original_filename,
-                        mimetype='application/octet-stream')
-    except Exception as e:
-        logger.error(f"ファイル送信エラー: {e}")
-        return render_template("error.html", error="ファイルの送信中にエラーが発生しました。")
+    def close(self):
+        self.f.close()
+
+def plan_file_response(file_path, etag, download_name, inline, request_headers):
+    """Range/条件付きリクエストを解釈して応答内容を決める（Flask/ASGI共通）
+
+    戻り値: (status, headers, mimetype, start, length) ※lengthがNoneなら本文なし
+    """
+    etag = f'"{etag}"'
+    size = os.path.getsize(file_path)
+    disposition = "inline" if inline else "attachment"
+    ascii_name = download_name.encode("ascii", "ignore").decode() or "download"
+    headers = {
+        "ETag": etag,
+        "Accept-Ranges": "bytes",
+        "Cache-Control": "private, max-age=3600",
+        "Content-Disposition": f"{disposition}; filename=\"{ascii_name}\"; filename*=UTF-8''{quote(download_name)}",
+    }
+    mimetype = MIME_TYPES.get(os.path.splitext(file_path)[1].lower(), "application/octet-stream")
+
+    if etag_matches(request_headers.get("If-None-Match"), etag):
+        return 304, headers, mimetype, 0, None
+
+    # nginx / Apache にファイル送信を任せる
+    if SENDFILE_MODE == "x-accel":
+        headers["X-Accel-Redirect"] = X_ACCEL_PREFIX + quote(os.path.basename(file_path))
+        return 200, headers, mimetype, 0, None
+    if SENDFILE_MODE == "x-sendfile":
+        headers["X-Sendfile"] = os.path.abspath(file_path)
+        return 200, headers, mimetype, 0, None
+
+    status = 200
+    start, end = 0, size - 1
+    range_header = request_headers.get("Range")
+    if_range = request_headers.get("If-Range")
+    if range_header and (not if_range or if_range_matches(if_range, etag)):
+        byte_range = parse_range(range_header, size)
+        if byte_range == (None, None):
+            headers["Content-Range"] = f"bytes */{size}"
+            return 416, headers, mimetype, 0, None
+        if byte_range:
+            start, end = byte_range
+            status = 206
+            headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+
+    length = end - start + 1
+    headers["Content-Length"] = str(length)
+    return status, headers, mimetype, start, length
+
+def send_download(file_path, etag, download_name, inline=False):
+    """Range/条件付きリクエストに対応してファイルを送信"""
+    status, headers, mimetype, start, length = plan_file_response(
+        file_path, etag, download_name, inline, request.headers
+    )
+    if length is None:
+        return Response(status=status, headers=headers, mimetype=mimetype)
+
+    f = open(file_path, "rb")
+    f.seek(start)
+    # wsgi.file_wrapperはEOFまで読むサーバーもあるので、ファイル全体を返す200のときだけ使う
+    file_wrapper = request.environ.get("wsgi.file_wrapper")
+    if file_wrapper and status == 200:
+        body = file_wrapper(f, SEND_CHUNK_SIZE)
+    else:
+        body = FileRangeIterator(f, length)
+    return Response(body, status=status, headers=headers, mimetype=mimetype, direct_passthrough=True)
 
 @app.route("/api/status/<id>")
 def check_status(id):
     """ダウンロード状況をAPIで確認"""
+    return jsonify(get_status_payload(id))
+
+def get_status_payload(id):
+    """ジョブ・ダウンロード情報から現在の状況をまとめる"""
+    job = jobs.get(id)
+    if job:
+        if job["status"] == "queued":
+            return {"status": "queued", "queue_position": get_queue_position(id)}
+        if job["status"] == "failed":
+            return {"status": "failed", "error": job.get("error")}
+        if job["status"] == "running":
+            return {"status": "running"}
+
     info = download_info.get(id)
     if not info:
-        return jsonify({"status": "not_found"})
+        return {"status": "not_found"}
     
     if time.time() > info["expire"]:
-        return jsonify({"status": "expired"})
+        return {"status": "expired"}
     
     if os.path.exists(info["path"]):
-        return jsonify({"status": "ready", "title": info.get("title")})
+        return {
+            "status": "ready",
+            "title": info.get("title"),
+            "thumbnail": info.get("thumbnail"),
+            "filename": info.get("original_filename"),
+            "expires_at": int(info["expire"]),
+            "download_page": f"{BASE_URL}/video/{id}",
+            "direct_download": f"{BASE_URL}/download/{id}"
+        }
     
-    return jsonify({"status": "processing"})
+    return {"status": "processing"}
+
+@app.route("/api/progress/<id>")
+def progress_stream(id):
+    """ジョブ進捗をServer-Sent Eventsで配信"""
+    channel = progress_channels.get(id)
+
+    def stream():
+        if channel is None:
+            # 進行中のジョブがなければ現在の状況を1回だけ送る
+            yield sse_event(get_status_payload(id))
+            return
+        version = -1
+        while True:
+            version, state = channel.wait(version, SSE_KEEPALIVE_INTERVAL)
+            if state is None:
+                yield ": keep-alive\n\n"
+                continue
+            yield sse_event(state)
+            if state["status"] not in ACTIVE_JOB_STATUSES:
+                return
+
+    return Response(stream(), mimetype="text/event-stream", headers=SSE_HEADERS)
+
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "X-Accel-Buffering": "no"  # nginxのバッファリングを無効化
+}
+
+def sse_event(payload):
+    return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
 
 def cleanup_file(id):
     """ファイルクリーンアップ"""
+    info = download_info.get(id)
+    if info and info["expire"] > time.time():
+        # キャッシュヒットで期限が延長された場合は再スケジュール
+        expiry_scheduler.call_at(info["expire"], cleanup_file, id)
+        return
     info = download_info.pop(id, None)
     if info:
+        download_index.remove(id)
         try:
             if os.path.exists(info["path"]):
                 os.remove(info["path"])
@@ -238,25 +902,62 @@ def cleanup_file(id):
         except Exception as e:
             logger.error(f"ファイル削除エラー: {e}")
 
+orphan_scan_pending = set()  # 削除を予約済みの管理外ファイル（再走査で重複登録しない）
+
+def remove_orphan_file(filepath):
+    """管理外の古いファイルを削除（ダウンロード情報から参照中なら残す）"""
+    orphan_scan_pending.discard(filepath)
+    # ファイル名の先頭11文字がダウンロードID
+    info = download_info.get(os.path.basename(filepath)[:11])
+    if info and info["path"] == filepath:
+        return
+    try:
+        if os.path.isfile(filepath):
+            os.remove(filepath)
+            logger.info(f"古いファイルを削除: {filepath}")
+    except Exception as e:
+        logger.error(f"クリーンアップエラー: {e}")
+
 def cleanup_old_files():
-    """古いファイルの定期クリーンアップ"""
+    """既存ファイルを走査して削除をスケジューラーに登録し、ORPHAN_FILE_TTLごとに再走査"""
     try:
-        current_time = time.time()
         for folder in [DOWNLOAD_FOLDER, TEMP_FOLDER]:
             for filename in os.listdir(folder):
                 filepath = os.path.join(folder, filename)
-                if os.path.isfile(filepath):
-                    # 2時間以上古いファイルを削除
-                    if current_time - os.path.getctime(filepath) > 7200:
-                        os.remove(filepath)
-                        logger.info(f"古いファイルを削除: {filepath}")
+                if os.path.isfile(filepath) and filepath not in orphan_scan_pending:
+                    # 作成から2時間後に削除
+                    orphan_scan_pending.add(filepath)
+                    expiry_scheduler.call_at(os.path.getctime(filepath) + ORPHAN_FILE_TTL, remove_orphan_file, filepath)
     except Exception as e:
         logger.error(f"クリーンアップエラー: {e}")
+    finally:
+        # 失敗したダウンロードの残骸など、実行中に増えた管理外ファイルも拾う
+        expiry_scheduler.call_at(time.time() + ORPHAN_FILE_TTL, cleanup_old_files)
+
+cleanup_started = False
 
-# 定期クリーンアップを1時間ごとに実行
 def schedule_cleanup():
+    """起動時クリーンアップ（以降の削除と定期走査はスケジューラーが担当）"""
+    global cleanup_started
+    if cleanup_started:
+        return
+    cleanup_started = True
     cleanup_old_files()
-    threading.Timer(3600, schedule_cleanup).start()
+
+@app.route("/api/stats")
+def api_stats():
+    """ジョブキューと期限切れスケジューラーのメトリクス"""
+    return jsonify(get_stats())
+
+def get_stats():
+    with job_cond:
+        queued = len(job_queue)
+        running = sum(1 for job in jobs.values() if job["status"] == "running")
+    return {
+        "jobs": {"queued": queued, "running": running, "queue_limit": JOB_QUEUE_SIZE},
+        "downloads": len(download_info),
+        "expiry_scheduler": expiry_scheduler.stats()
+    }
 
 # === Discord Bot 設定 ===
 intents = Intents.default()
@@ -275,9 +976,14 @@ def is_on_cooldown(user_id, cmd_key, cooldown_seconds=180):
         return False
     return True
 
+def extract_video_id(link):
+    """URLから動画IDを取得（取得できなければURLそのもの）"""
+    match = re.search(r'(?:v=|shorts/|youtu\.be/)([\w-]{11})', link)
+    return match.group(1) if match else link
+
 def generate_id(link, fmt):
-    """ユニークIDを生成"""
-    content = f"{link}_{fmt}_{int(time.time())}"
+    """動画IDとフォーマットからIDを生成（同じ動画は同じID）"""
+    content = f"{extract_video_id(link)}_{fmt}"
     h = hashlib.sha256(content.encode()).digest()
     return base64.urlsafe_b64encode(h[:8]).decode("utf-8").rstrip('=')
 
@@ -296,14 +1002,52 @@ def extract_info_safe(link):
         logger.error(f"動画情報取得エラー: {e}")
         return None
 
-def download_video_safe(link, output_path, format_opt, is_audio=False):
+# === 動画情報キャッシュ（LRU + TTL） ===
+metadata_cache = OrderedDict()  # 動画ID: (取得時刻, info)
+metadata_lock = threading.Lock()
+
+def get_video_info(link):
+    """動画情報をキャッシュ経由で取得"""
+    key = extract_video_id(link)
+    now = time.time()
+    with metadata_lock:
+        cached = metadata_cache.get(key)
+        if cached and now - cached[0] < METADATA_CACHE_TTL:
+            metadata_cache.move_to_end(key)
+            return cached[1]
+
+    info = extract_info_safe(link)
+    if not info:
+        return None
+
+    with metadata_lock:
+        metadata_cache[key] = (now, info)
+        metadata_cache.move_to_end(key)
+        while len(metadata_cache) > METADATA_CACHE_SIZE:
+            metadata_cache.popitem(last=False)
+    return info
+
+def get_downloaded_filepath(result):
+    """yt-dlpの結果から最終的なファイルパスを取得（後処理後のパス）"""
+    downloads = result.get('requested_downloads') or []
+    if downloads:
+        return downloads[-1].get('filepath')
+    return result.get('filepath')
+
+def download_video_safe(link, output_path, format_opt, is_audio=False, progress_hook=None, info=None):
     """安全にダウンロード実行"""
-    # 一時ファイルパスを生成
-    temp_path = os.path.join(TEMP_FOLDER, f"temp_{os.path.basename(output_path)}")
+    # 一時ファイルパスを生成（拡張子はyt-dlpに決定させる）
+    temp_base = os.path.join(TEMP_FOLDER, f"temp_{os.path.splitext(os.path.basename(output_path))[0]}")
+    touched_files = set()  # 失敗時に削除するファイル
+    
+    def track_files(d):
+        for key in ('filename', 'tmpfilename'):
+            if d.get(key):
+                touched_files.add(d[key])
     
     ydl_opts = {
         'format': format_opt,
-        'outtmpl': temp_path,
+        'outtmpl': temp_base.replace('%', '%%') + '.%(ext)s',
         'quiet': True,
         'no_warnings': True,
         'continuedl': True,
@@ -313,8 +1057,13 @@ def download_video_safe(link, output_path, format_opt, is_audio=False):
         'writeinfojson': False,
         'writesubtitles': False,
         'writeautomaticsub': False,
+        'progress_hooks': [track_files],
     }
     
+    if progress_hook:
+        ydl_opts['progress_hooks'].append(progress_hook)
+        ydl_opts['postprocessor_hooks'] = [progress_hook]
+    
     # 音声の場合の追加設定
     if is_audio:
         ydl_opts.update({
@@ -327,44 +1076,57 @@ def download_video_safe(link, output_path, format_opt, is_audio=False):
     
     try:
         with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            ydl.download([link])
+            if info:
+                # process_ie_resultは辞書を書き換えるのでキャッシュの複製を渡す
+                result = ydl.process_ie_result(copy.deepcopy(info), download=True)
+            else:
+                result = ydl.extract_info(link, download=True)
         
-        # 実際に作成されたファイルを探す
-        base_temp = os.path.splitext(temp_path)[0]
-        possible_extensions = ['mp4', 'webm', 'mp3', 'm4a', 'mkv'] if not is_audio else ['mp3', 'm4a']
-        
-        actual_file = None
-        for ext in possible_extensions:
-            test_path = f"{base_temp}.{ext}"
-            if os.path.exists(test_path):
-                actual_file = test_path
-                break
-        
-        if not actual_file:
-            # 元のパスをチェック
-            if os.path.exists(temp_path):
-                actual_file = temp_path
-        
-        if actual_file and os.path.exists(actual_file):
-            # 最終的な出力パスに移動
-            final_ext = os.path.splitext(actual_file)[1]
-            final_output = os.path.splitext(output_path)[0] + final_ext
-            os.rename(actual_file, final_output)
-            return final_output
-        else:
+        # yt-dlpが報告したファイルパスをそのまま使う（ディレクトリは走査しない）
+        actual_file = get_downloaded_filepath(result)
+        if not actual_file or not os.path.exists(actual_file):
             raise Exception("ダウンロードされたファイルが見つかりません")
+        touched_files.add(actual_file)
+        
+        # 最終的な出力パスに移動
+        final_ext = os.path.splitext(actual_file)[1]
+        final_output = os.path.splitext(output_path)[0] + final_ext
+        os.rename(actual_file, final_output)
+        return final_output
             
     except Exception as e:
         # 一時ファイルのクリーンアップ
-        for ext in ['mp4', 'webm', 'mp3', 'm4a', 'mkv']:
-            test_path = f"{base_temp}.{ext}"
-            if os.path.exists(test_path):
-                try:
-                    os.remove(test_path)
-                except:
-                    pass
+        for path in touched_files:
+            try:
+                if os.path.exists(path):
+                    os.remove(path)
+            except:
+                pass
         raise e
 
+# Bot用ダウンロードExecutor（イベントループ外で yt-dlp を実行）
+bot_executor = ThreadPoolExecutor(max_workers=BOT_DOWNLOAD_WORKERS, thread_name_prefix="bot-download")
+bot_download_slots = asyncio.Semaphore(BOT_DOWNLOAD_WORKERS)
+
+def make_progress_hook(loop, message):
+    """yt-dlpの進捗をDiscordメッセージの編集に変換するフック"""
+    last_update = [0.0]
+
+    def hook(d):
+        now = time.time()
+        if d.get('status') != 'downloading' or now - last_update[0] < PROGRESS_UPDATE_INTERVAL:
+            return
+        last_update[0] = now
+
+        total = d.get('total_bytes') or d.get('total_bytes_estimate')
+        percent = d.get('downloaded_bytes', 0) / total * 100 if total else 0
+        title = d.get('info_dict', {}).get('title', '')
+        content = f"📥 ダウンロード中: {title[:50]}... {percent:.0f}%"
+        # ワーカースレッドからイベントループへ編集を依頼
+        asyncio.run_coroutine_threadsafe(message.edit(content=content), loop)
+
+    return hook
+
 async def handle_download(interaction: Interaction, link: str, fmt: str, is_audio: bool):
     """ダウンロード処理のメインハンドラー"""
     user_id = interaction.user.id
@@ -380,51 +1142,37 @@ async def handle_download(interaction: Interaction, link: str, fmt: str, is_audi
         await interaction.response.send_message("⏳ スパム防止のため、3分待ってください。", ephemeral=True)
         return
 
-    await interaction.response.send_message("📥 動画情報を取得中...", ephemeral=True)
-    
-    # 動画情報取得
-    info = extract_info_safe(link)
-    if not info:
-        await interaction.followup.send("❌ 動画情報を取得できませんでした。URLを確認してください。", ephemeral=True)
-        return
-    
-    # ID生成とファイルパス設定
-    file_id = generate_id(link, fmt)
-    title = info.get("title", "Unknown Video")
-    safe_filename = get_safe_filename(info, file_id, is_audio)
-    output_path = os.path.join(DOWNLOAD_FOLDER, safe_filename)
+    await interaction.response.send_message("📥 リクエストを受け付けました...", ephemeral=True)
     
-    await interaction.followup.send(f"📥 ダウンロード開始: {title[:50]}...", ephemeral=True)
+    loop = asyncio.get_running_loop()
+    if bot_download_slots.locked():
+        await interaction.edit_original_response(content="⏳ 他のダウンロードが完了するまで順番待ち中...")
     
-    try:
-        # ダウンロード実行
-        final_path = download_video_safe(link, output_path, fmt, is_audio)
-        
-        # ダウンロード情報を保存
-        download_info[file_id] = {
-            'path': final_path,
-            'expire': time.time() + 3600,  # 1時間後に期限切れ
-            'title': title,
-            'thumbnail': info.get("thumbnail"),
-            'original_filename': os.path.basename(final_path)
-        }
+    async with bot_download_slots:
+        file_id = generate_id(link, fmt)
+        status_message = await interaction.followup.send("📥 ダウンロード準備中...", ephemeral=True, wait=True)
+        progress_hook = make_progress_hook(loop, status_message)
         
-        # 1時間後にクリーンアップをスケジュール
-        threading.Timer(3600, cleanup_file, args=(file_id,)).start()
-        
-        # 成功メッセージ
-        download_url = f"{BASE_URL}/video/{file_id}"
-        await interaction.followup.send(
-            f"✅ **ダウンロード完了！**\n"
-            f"📹 {title[:100]}\n"
-            f"🔗 [ダウンロードページ]({download_url})\n"
-            f"⏰ 有効期限: 1時間", 
-            ephemeral=True
-        )
-        
-    except Exception as e:
-        logger.error(f"ダウンロードエラー: {e}")
-        await interaction.followup.send(f"❌ ダウンロードに失敗しました: {str(e)[:100]}", ephemeral=True)
+        try:
+            # ダウンロード実行（キャッシュ済み・処理中の同一動画は共有）
+            entry = await loop.run_in_executor(
+                bot_executor, ensure_download, file_id, link, fmt, is_audio, progress_hook
+            )
+            title = entry.get("title", "Unknown Video")
+            
+            # 成功メッセージ
+            download_url = f"{BASE_URL}/video/{file_id}"
+            await interaction.followup.send(
+                f"✅ **ダウンロード完了！**\n"
+                f"📹 {title[:100]}\n"
+                f"🔗 [ダウンロードページ]({download_url})\n"
+                f"⏰ 有効期限: 1時間", 
+                ephemeral=True
+            )
+            
+        except Exception as e:
+            logger.error(f"ダウンロードエラー: {e}")
+            await interaction.followup.send(f"❌ ダウンロードに失敗しました: {str(e)[:100]}", ephemeral=True)
 
 # === Discord コマンド ===
 @tree.command(name="videomp4", description="YouTube動画をMP4でダウンロード")
@@ -477,7 +1225,7 @@ async def on_ready():
     try:
         synced = await tree.sync()
         logger.info(f"✅ Bot起動完了: {client.user} | {len(synced)}個のコマンドを同期")
-        schedule_cleanup()  # 定期クリーンアップ開始
+        schedule_cleanup()  # 起動時クリーンアップ
     except Exception as e:
         logger.error(f"コマンド同期エラー: {e}")
 
@@ -485,6 +1233,141 @@ async def on_ready():
 async def on_command_error(ctx, error):
     logger.error(f"コマンドエラー: {error}")
 
+# === ASGI サーバー（Botと同じイベントループで動作） ===
+class AsyncDownloadManager:
+    """ASGIモード用: イベントループ上のタスクがジョブキューを処理し、ダウンロードはExecutorで実行"""
+
+    def __init__(self, workers):
+        self.workers = workers
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="asgi-download")
+        self._loop = None
+        self._wakeup = None
+        self._tasks = []
+
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        start_job_executor()
+        self._tasks = [self._loop.create_task(self._worker()) for _ in range(self.workers)]
+        logger.info(f"非同期ダウンロードマネージャー起動: {self.workers}個 ({JOB_EXECUTOR})")
+
+    def notify(self):
+        """新しいジョブを通知（どのスレッドからでも呼べる）"""
+        self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    async def _worker(self):
+        while True:
+            with job_cond:
+                job_id = take_next_job() if job_queue else None
+            if job_id is None:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            await self._loop.run_in_executor(self._executor, run_job, job_id)
+
+def render_asgi_template(template, context):
+    """Flaskのテンプレート環境でHTMLを生成"""
+    with app.app_context():
+        return HTMLResponse(render_template(template, **context))
+
+async def read_file_range(file_path, start, length):
+    """ファイルの指定範囲をイベントループを止めずに読み出す"""
+    loop = asyncio.get_running_loop()
+    fd = os.open(file_path, os.O_RDONLY)
+    try:
+        offset, end = start, start + length
+        while offset < end:
+            chunk = await loop.run_in_executor(None, os.pread, fd, min(SEND_CHUNK_SIZE, end - offset), offset)
+            if not chunk:
+                break
+            offset += len(chunk)
+            yield chunk
+    finally:
+        os.close(fd)
+
+async def asgi_index(request):
+    return render_asgi_template("index.html", {})
+
+async def asgi_api_download(request):
+    try:
+        data = await request.json()
+    except Exception:
+        data = None
+    payload, status, headers = create_download_job(data)
+    return JSONResponse(payload, status_code=status, headers=headers)
+
+async def asgi_api_info(request):
+    return JSONResponse(get_api_info())
+
+async def asgi_api_stats(request):
+    return JSONResponse(get_stats())
+
+async def asgi_video_page(request):
+    template, context = get_video_page(request.path_params["id"])
+    return render_asgi_template(template, context)
+
+async def asgi_download_file(request):
+    loop = asyncio.get_running_loop()
+    # ETag未計算の場合はハッシュ計算が走るのでExecutorで実行
+    info, error = await loop.run_in_executor(None, resolve_download, request.path_params["id"])
+    if error:
+        return render_asgi_template("error.html", {"error": error})
+
+    status, headers, mimetype, start, length = plan_file_response(
+        info["path"], info["etag"], info.get("original_filename", "video.mp4"),
+        request.query_params.get("inline") == "1", request.headers
+    )
+    if length is None:
+        return ASGIResponse(status_code=status, headers=headers, media_type=mimetype)
+    return StreamingResponse(read_file_range(info["path"], start, length),
+                             status_code=status, headers=headers, media_type=mimetype)
+
+async def asgi_check_status(request):
+    return JSONResponse(get_status_payload(request.path_params["id"]))
+
+async def asgi_progress_stream(request):
+    id = request.path_params["id"]
+    channel = progress_channels.get(id)
+
+    async def stream():
+        if channel is None:
+            yield sse_event(get_status_payload(id))
+            return
+        version = -1
+        while True:
+            version, state = await channel.wait_async(version, SSE_KEEPALIVE_INTERVAL)
+            if state is None:
+                yield ": keep-alive\n\n"
+                continue
+            yield sse_event(state)
+            if state["status"] not in ACTIVE_JOB_STATUSES:
+                return
+
+    return StreamingResponse(stream(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+def create_asgi_app():
+    """Flaskと同じ処理を使うStarletteアプリ"""
+    return Starlette(routes=[
+        Route("/", asgi_index),
+        Route("/api/download", asgi_api_download, methods=["POST"]),
+        Route("/api/info", asgi_api_info),
+        Route("/api/stats", asgi_api_stats),
+        Route("/video/{id}", asgi_video_page),
+        Route("/download/{id}", asgi_download_file),
+        Route("/api/status/{id}", asgi_check_status),
+        Route("/api/progress/{id}", asgi_progress_stream),
+    ])
+
+async def serve_asgi_with_bot():
+    """ASGIサーバーとDiscord Botを同じイベントループで起動"""
+    global async_download_manager
+    async_download_manager = AsyncDownloadManager(JOB_WORKERS)
+    async_download_manager.start()
+
+    server = uvicorn.Server(uvicorn.Config(create_asgi_app(), host="0.0.0.0", port=PORT, log_level="info"))
+    async with client:
+        await asyncio.gather(server.serve(), client.start(TOKEN))
+
 # === Flask起動 ===
 def run_flask():
     app.run(host="0.0.0.0", port=PORT, debug=False)
@@ -495,12 +1378,29 @@ if __name__ == "__main__":
         logger.error("DISCORD_TOKENが設定されていません")
         exit(1)
     
-    # Flask を別スレッドで起動
-    flask_thread = threading.Thread(target=run_flask, daemon=True)
-    flask_thread.start()
+    # プロセスモードのExecutorはスレッドを起動する前に作成
+    start_job_executor()
+
+    # 前回までのダウンロード情報を復元
+    restore_downloads()
     
-    # Discord Bot起動
-    try:
-        client.run(TOKEN)
-    except Exception as e:
-        logger.error(f"Bot起動エラー: {e}")
+    if SERVER_MODE == "asgi":
+        if Starlette is None:
+            logger.error("ASGIモードには starlette と uvicorn が必要です")
+            exit(1)
+        
+        # ASGIサーバーとBotを同じイベントループで起動
+        try:
+            asyncio.run(serve_asgi_with_bot())
+        except Exception as e:
+            logger.error(f"起動エラー: {e}")
+    else:
+        # Flask を別スレッドで起動
+        flask_thread = threading.Thread(target=run_flask, daemon=True)
+        flask_thread.start()
+        
+        # Discord Bot起動
+        try:
+            client.run(TOKEN)
+        except Exception as e:
+            logger.error(f"Bot起動エラー: {e}")
@@ -1,24 +1,75 @@
 import os
+import re
+import json
 import time
+import asyncio
+import queue
+import shutil
+import threading
 import tempfile
-import subprocess
 import base64
 import hashlib
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from urllib.parse import quote
+import requests
+from requests.adapters import HTTPAdapter
 from discord import app_commands, Intents, Client, Interaction
 import discord
 import yt_dlp
 
+try:
+    import boto3
+    from botocore.config import Config as BotoConfig
+except ImportError:
+    boto3 = None
+
 # === 設定 ===
 TOKEN = "YOUR_DISCORD_BOT_TOKEN"
 COOLDOWN_SECONDS = 180
 MAX_FILE_SIZE_MB = 1024 * 10  # 10 GB（transfer.sh制限）
 
+# アップロード先: transfersh / local / s3
+UPLOAD_TARGET = os.getenv("UPLOAD_TARGET", "transfersh")
+TRANSFER_SH_URL = os.getenv("TRANSFER_SH_URL", "https://transfer.sh")
+LOCAL_UPLOAD_DIR = os.getenv("LOCAL_UPLOAD_DIR", "uploads")  # 静的配信するディレクトリ
+LOCAL_UPLOAD_BASE_URL = os.getenv("LOCAL_UPLOAD_BASE_URL", "http://localhost:8000/uploads")
+S3_BUCKET = os.getenv("S3_BUCKET", "ydl")
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL")  # MinIO等のS3互換サーバー（未設定ならAWS）
+S3_URL_EXPIRES = 60 * 60 * 24  # 署名付きURLの有効期限（秒）
+
+# アップロード先がファイルを保持する期間（結果キャッシュの有効期限に使う）
+TRANSFER_SH_RETENTION = 60 * 60 * 24 * 14  # transfer.sh は14日
+LOCAL_UPLOAD_RETENTION = 60 * 60 * 24 * 7  # ローカル配信ディレクトリのファイルを残しておく期間
+
+# 結果キャッシュ（動画ID+フォーマット : アップロード済みURL）
+RESULT_CACHE_PATH = os.getenv("RESULT_CACHE_PATH", "ydl_cache.json")
+RESULT_CACHE_SIZE = 1000
+
+# ダウンロードキュー（同時実行数の上限と、ユーザー間のラウンドロビン）
+DOWNLOAD_WORKERS = int(os.getenv("DOWNLOAD_WORKERS", "2"))
+DOWNLOAD_QUEUE_SIZE = 100  # 待機できるジョブ数の上限
+
+# アップロードのタイムアウト
+# 接続・送信・応答待ちの1回ごとの無通信時間と、全体の期限（基本時間 + サイズ / 最低速度）の2段構え
+UPLOAD_CONNECT_TIMEOUT = 10  # 接続と送信（requests/urllib3は送信中もこの値を使う）
+UPLOAD_STALL_TIMEOUT = 60  # 送信後にレスポンスを待つ時間
+UPLOAD_TIMEOUT_BASE = 30
+UPLOAD_MIN_SPEED = 1024 * 1024  # 1 MB/s
+UPLOAD_POOL_SIZE = 8
+
+# パススルー: 結合・変換の要らない単一HTTP(S)フォーマットは一時ファイルを経由せずに転送する
+PASS_THROUGH = os.getenv("PASS_THROUGH", "1") == "1"
+PIPE_CHUNK_SIZE = 1024 * 1024
+PIPE_MAX_CHUNKS = 16  # バッファ上限 = 16 MB（満杯の間はダウンロード側が待つ）
+PASS_THROUGH_RANGE_SIZE = 10 * 1024 * 1024  # 1回のRangeリクエストのサイズ（一括取得は速度制限されやすい）
+DOWNLOAD_READ_TIMEOUT = 60
+
 # === Discord Bot ===
 intents = Intents.default()
 client = Client(intents=intents)
 tree = app_commands.CommandTree(client)
 cooldowns = {}
-cache = {}  # URL+format : uploaded link
 
 # === ヘルパー ===
 def is_on_cooldown(user_id, cmd_key):
@@ -29,42 +80,385 @@ def is_on_cooldown(user_id, cmd_key):
         return False
     return True
 
+def extract_video_id(link):
+    """URLから動画IDを取得（youtu.be / watch?v= / shorts 等の表記ゆれを吸収、取得できなければURLそのもの）"""
+    match = re.search(r'(?:v=|shorts/|youtu\.be/|embed/|live/)([\w-]{11})', link)
+    return match.group(1) if match else link.strip()
+
 def generate_id(link):
     return base64.urlsafe_b64encode(hashlib.sha256(link.encode()).digest()[:6]).decode()
 
 def sanitize_filename(name):
     return "".join(c if c.isalnum() or c in "-_()[]" else "_" for c in name)[:100]
 
-def get_title(link):
+# === アップロード ===
+# Keep-Aliveの接続を使い回す（curlを毎回起動しない）
+upload_session = requests.Session()
+upload_session.mount("https://", HTTPAdapter(pool_connections=UPLOAD_POOL_SIZE, pool_maxsize=UPLOAD_POOL_SIZE))
+upload_session.mount("http://", HTTPAdapter(pool_connections=UPLOAD_POOL_SIZE, pool_maxsize=UPLOAD_POOL_SIZE))
+
+class UploadDeadline:
+    """アップロード元をラップし、read() のたびに全体の期限を超えていないか確かめる
+
+    期限 = 基本時間 + max(サイズ, 読んだバイト数) / 最低速度。サイズ不明なら平均速度の下限になる。
+    """
+
+    def __init__(self, fileobj, size):
+        self.fileobj = fileobj
+        self.size = size
+        self.transferred = 0
+        self.started = time.monotonic()
+
+    def read(self, n=-1):
+        limit = UPLOAD_TIMEOUT_BASE + max(self.size or 0, self.transferred) / UPLOAD_MIN_SPEED
+        if time.monotonic() - self.started > limit:
+            raise Exception(f"アップロードがタイムアウトしました（{limit:.0f}秒）")
+        data = self.fileobj.read(n)
+        self.transferred += len(data)
+        return data
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(PIPE_CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+    def __len__(self):
+        # requestsはこれを見てContent-Lengthを付ける（0ならchunked転送）
+        return self.size or 0
+
+    def __bool__(self):
+        return True
+
+def upload_with_deadline(fileobj, filename, size):
+    """全体の期限つきでアップロード先に送る"""
+    return upload_target.upload(UploadDeadline(fileobj, size), filename, size)
+
+class TransferShTarget:
+    """transfer.sh 互換サーバーへPUTでストリーミングアップロード"""
+
+    retention = TRANSFER_SH_RETENTION
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip("/")
+
+    def upload(self, fileobj, filename, size):
+        response = upload_session.put(
+            f"{self.base_url}/{quote(filename)}",
+            data=fileobj,  # 一定サイズずつ読みながら送信される
+            timeout=(UPLOAD_CONNECT_TIMEOUT, UPLOAD_STALL_TIMEOUT),
+        )
+        if response.status_code >= 400:
+            raise Exception(f"アップロードエラー: HTTP {response.status_code} {response.text[:200]}")
+        return response.text.strip()
+
+class LocalDirTarget:
+    """ローカルの静的配信ディレクトリに保存してURLを返す"""
+
+    retention = LOCAL_UPLOAD_RETENTION
+
+    def __init__(self, directory, base_url):
+        self.directory = directory
+        self.base_url = base_url.rstrip("/")
+
+    def upload(self, fileobj, filename, size):
+        # 同名ファイルを上書きしないようにランダムなサブディレクトリに置く
+        token = base64.urlsafe_b64encode(os.urandom(9)).decode()
+        directory = os.path.join(self.directory, token)
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, filename)
+        try:
+            with open(path + ".part", "wb") as f:
+                shutil.copyfileobj(fileobj, f, 1024 * 1024)
+            os.replace(path + ".part", path)
+        except BaseException:
+            # 途中で失敗したら書きかけの .part ごとサブディレクトリを消す
+            shutil.rmtree(directory, ignore_errors=True)
+            raise
+        return f"{self.base_url}/{token}/{quote(filename)}"
+
+class S3Target:
+    """S3互換ストレージにマルチパートでアップロードし、署名付きURLを返す"""
+
+    retention = S3_URL_EXPIRES
+
+    def __init__(self, bucket, endpoint_url=None):
+        if boto3 is None:
+            raise RuntimeError("S3へのアップロードには boto3 が必要です（pip install boto3）")
+        self.bucket = bucket
+        self.client = boto3.client("s3", endpoint_url=endpoint_url, config=BotoConfig(
+            connect_timeout=UPLOAD_CONNECT_TIMEOUT, read_timeout=UPLOAD_STALL_TIMEOUT
+        ))
+
+    def upload(self, fileobj, filename, size):
+        key = f"{base64.urlsafe_b64encode(os.urandom(9)).decode()}/{filename}"
+        self.client.upload_fileobj(fileobj, self.bucket, key)
+        return self.client.generate_presigned_url(
+            "get_object", Params={"Bucket": self.bucket, "Key": key}, ExpiresIn=S3_URL_EXPIRES
+        )
+
+def create_upload_target(name):
+    if name == "local":
+        return LocalDirTarget(LOCAL_UPLOAD_DIR, LOCAL_UPLOAD_BASE_URL)
+    if name == "s3":
+        return S3Target(S3_BUCKET, S3_ENDPOINT_URL)
+    return TransferShTarget(TRANSFER_SH_URL)
+
+upload_target = create_upload_target(UPLOAD_TARGET)
+
+# === 結果キャッシュ ===
+class ResultCache:
+    """アップロード済みURLのキャッシュ（件数上限つきLRU、アップロード先の保持期間で失効、JSONに永続化）"""
+
+    def __init__(self, path, max_entries, ttl):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # キー: (URL, 期限)
+        self._lock = threading.Lock()
+        self._load()
+
+    @staticmethod
+    def make_key(link, fmt):
+        return f"{extract_video_id(link)}:{fmt}"
+
+    def _load(self):
+        # 壊れた・手で編集されたファイルは丸ごと捨てる（起動を止めない）
+        now = time.time()
+        loaded = OrderedDict()
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                entries = json.load(f)
+            if not isinstance(entries, list):
+                raise ValueError("list ではありません")
+            for key, url, expires_at in entries:
+                if not isinstance(key, str) or not isinstance(url, str):
+                    raise ValueError("不正なエントリー")
+                if float(expires_at) > now:
+                    loaded[key] = (url, float(expires_at))
+        except (OSError, TypeError, ValueError):
+            return
+        self._entries = loaded
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _save(self):
+        # 書き込み途中で落ちても壊れないよう一時ファイルに書いてから置き換える
+        entries = [[key, url, expires_at] for key, (url, expires_at) in self._entries.items()]
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(entries, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"⚠️ キャッシュの保存に失敗しました: {e}")
+
+    def get(self, link, fmt):
+        key = self.make_key(link, fmt)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            url, expires_at = entry
+            if expires_at <= time.time():
+                del self._entries[key]
+                self._save()
+                return None
+            self._entries.move_to_end(key)
+            return url
+
+    def put(self, link, fmt, url):
+        key = self.make_key(link, fmt)
+        with self._lock:
+            self._entries[key] = (url, time.time() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            self._save()
+
+cache = ResultCache(RESULT_CACHE_PATH, RESULT_CACHE_SIZE, upload_target.retention)
+
+# === パススルー転送 ===
+class StreamPipe:
+    """ダウンロード（生産者）とアップロード（消費者）をつなぐ有界バッファ
+
+    消費者側はファイルのように read() / 反復できるので、そのままアップロード先に渡せる。
+    """
+
+    def __init__(self, size, max_chunks):
+        self.size = size  # 不明ならNone（アップロードはchunked転送になる）
+        self.transferred = 0
+        self.closed = False
+        self._queue = queue.Queue(maxsize=max_chunks)
+        self._error = None
+        self._chunk = b""
+        self._offset = 0
+        self._eof = False
+
+    # 生産者側
+    def put(self, chunk):
+        """チャンクを渡す（満杯なら待つ）。消費者が閉じていればFalse"""
+        while not self.closed:
+            try:
+                self._queue.put(chunk, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def finish(self, error=None):
+        self._error = error
+        self.put(None)
+
+    # 消費者側
+    def _next_chunk(self):
+        if self._eof:
+            return b""
+        chunk = self._queue.get()
+        if chunk is None:
+            self._eof = True
+            if self._error is not None:
+                raise Exception(f"ダウンロードエラー: {self._error}")
+            if self.size is not None and self.transferred != self.size:
+                raise Exception("ダウンロードが途中で終了しました")
+            return b""
+        self.transferred += len(chunk)
+        if self.transferred > MAX_FILE_SIZE_MB * 1024 * 1024:
+            raise Exception(f"ファイルサイズが大きすぎます（{self.transferred / (1024 * 1024):.2f}MB以上）")
+        return chunk
+
+    def read(self, n=-1):
+        parts = []
+        while n is None or n < 0 or n > 0:
+            if self._offset >= len(self._chunk):
+                self._chunk, self._offset = self._next_chunk(), 0
+                if not self._chunk:
+                    break
+            end = len(self._chunk) if n is None or n < 0 else min(len(self._chunk), self._offset + n)
+            parts.append(self._chunk[self._offset:end])
+            if n is not None and n >= 0:
+                n -= end - self._offset
+            self._offset = end
+        return b"".join(parts)
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(PIPE_CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+    def __len__(self):
+        # requestsはこれを見てContent-Lengthを付ける（0ならchunked転送）
+        return self.size or 0
+
+    def __bool__(self):
+        # __len__ が0でも空のボディ扱いされないようにする（requestsは data or {} で判定する）
+        return True
+
+    def close(self):
+        self.closed = True
+
+def stream_download(url, http_headers, pipe):
+    """Rangeリクエストを繰り返してパイプに流し込む（生産者スレッド）"""
     try:
-        with yt_dlp.YoutubeDL({'quiet': True}) as ydl:
-            info = ydl.extract_info(link, download=False)
-            return info.get("title", "video")
-    except Exception:
-        return "video"
+        start = 0
+        while True:
+            headers = dict(http_headers, Range=f"bytes={start}-{start + PASS_THROUGH_RANGE_SIZE - 1}")
+            with upload_session.get(url, headers=headers, stream=True,
+                                    timeout=(UPLOAD_CONNECT_TIMEOUT, DOWNLOAD_READ_TIMEOUT)) as response:
+                response.raise_for_status()
+                received = 0
+                for chunk in response.iter_content(PIPE_CHUNK_SIZE):
+                    if not pipe.put(chunk):
+                        return  # アップロード側が中断した
+                    received += len(chunk)
+            if response.status_code != 206:
+                break  # Range非対応のサーバーは1回で全体を返す
+            start += received
+            total = response.headers.get("Content-Range", "").rpartition("/")[2]
+            if received == 0 or (total.isdigit() and start >= int(total)):
+                break
+        pipe.finish()
+    except Exception as e:
+        pipe.finish(e)
 
-def download_and_upload(link, format_opt, is_audio):
-    ext = "mp3" if is_audio else "mp4"
-    title = sanitize_filename(get_title(link))
-    filename = f"{title}.{ext}"
+def can_pass_through(info):
+    """結合・変換なしでそのまま転送できるフォーマットか"""
+    return (
+        info.get("_type", "video") == "video"
+        and not info.get("requested_formats")  # 映像+音声の結合が必要
+        and info.get("protocol") in ("http", "https")  # HLS/DASH等は断片の結合が必要
+        and bool(info.get("url"))
+    )
+
+def stream_and_upload(info, filename):
+    """ダウンロードしながら同時にアップロードする（一時ファイルを使わない）"""
+    size = info.get("filesize")
+    if size and size > MAX_FILE_SIZE_MB * 1024 * 1024:
+        raise Exception(f"ファイルサイズが大きすぎます（{size / (1024 * 1024):.2f}MB）")
+
+    pipe = StreamPipe(size, PIPE_MAX_CHUNKS)
+    producer = threading.Thread(target=stream_download, args=(info["url"], info.get("http_headers") or {}, pipe),
+                                daemon=True)
+    producer.start()
+    try:
+        return upload_with_deadline(pipe, filename, size)
+    finally:
+        pipe.close()
 
-    with tempfile.TemporaryDirectory() as tmpdir:
-        output_path = os.path.join(tmpdir, filename)
+# === ダウンロード ===
+# YoutubeDLはスレッドセーフではないので、ワーカーごとにフォーマット別のインスタンスを使い回す
+worker_state = threading.local()
 
-        ydl_opts = {
+def get_worker_ydl(format_opt):
+    """このワーカー用の (YoutubeDL, 作業ディレクトリ) を返す"""
+    if not hasattr(worker_state, "ydls"):
+        worker_state.ydls = {}
+        worker_state.workdir = tempfile.mkdtemp(prefix="ydl-worker-")
+    ydl = worker_state.ydls.get(format_opt)
+    if ydl is None:
+        ydl = yt_dlp.YoutubeDL({
             'format': format_opt,
-            'outtmpl': output_path,
+            'outtmpl': os.path.join(worker_state.workdir, '%(id)s.%(ext)s'),
             'quiet': True,
             'noplaylist': True,
             'continuedl': True,
             'retries': 3,
             'no_warnings': True,
-        }
+        })
+        worker_state.ydls[format_opt] = ydl
+    return ydl, worker_state.workdir
+
+def clear_workdir(workdir):
+    """作業ディレクトリのファイル（途中で失敗した .part 等も）を削除"""
+    for name in os.listdir(workdir):
+        try:
+            os.remove(os.path.join(workdir, name))
+        except OSError:
+            pass
+
+def download_and_upload(link, format_opt, is_audio):
+    ext = "mp3" if is_audio else "mp4"
+    ydl, workdir = get_worker_ydl(format_opt)
 
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            ydl.download([link])
+    # 情報の取得は1回だけ（タイトルもフォーマット選択もこの結果を使う）
+    info = ydl.extract_info(link, download=False)
+    if info.get("_type", "video") != "video":
+        raise Exception("プレイリストには対応していません")
+    title = sanitize_filename(info.get("title") or "video")
+    filename = f"{title}.{ext}"
+
+    if PASS_THROUGH and can_pass_through(info):
+        return stream_and_upload(info, filename)
 
-        if not os.path.exists(output_path):
+    # 結合・変換が必要な場合は作業ディレクトリに保存してからアップロード
+    try:
+        info = ydl.process_ie_result(info, download=True)  # 取得済みの情報からダウンロード（再取得しない）
+        downloads = info.get("requested_downloads") or []
+        output_path = downloads[-1].get("filepath") if downloads else None
+        if not output_path or not os.path.exists(output_path):
             raise Exception("ダウンロードに失敗しました")
 
         # ファイルサイズ制限チェック（transfer.shは10GBまで）
@@ -72,36 +466,121 @@ def download_and_upload(link, format_opt, is_audio):
         if size_mb > MAX_FILE_SIZE_MB:
             raise Exception(f"ファイルサイズが大きすぎます（{size_mb:.2f}MB）")
 
-        result = subprocess.run(
-            ["curl", "--upload-file", output_path, f"https://transfer.sh/{filename}"],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            timeout=90
-        )
+        # ファイルを読みながらそのまま送信（全体をメモリに載せない）
+        with open(output_path, "rb") as f:
+            return upload_with_deadline(f, filename, os.path.getsize(output_path))
+    finally:
+        clear_workdir(workdir)
+
+# === ダウンロードキュー ===
+class FairDownloadQueue:
+    """ユーザーごとの待ち行列をラウンドロビンで取り出すワーカープール
 
-        if result.returncode != 0:
-            raise Exception(f"curlエラー: {result.stderr.decode()}")
+    1人が大量に依頼しても、他のユーザーのジョブは1周ごとに1件ずつ順番が回ってくる。
+    """
 
-        return result.stdout.decode().strip()
+    def __init__(self, workers, max_waiting):
+        self.workers = workers
+        self.max_waiting = max_waiting
+        self.running = 0
+        self._queues = OrderedDict()  # user_id: deque[(Future, func, args)]（先頭のユーザーから取り出す）
+        self._cond = threading.Condition()
+        self._started = False
+
+    def submit(self, user_id, func, *args):
+        """ジョブを登録して (Future, 待ち順) を返す（満杯なら (None, 0)）"""
+        future = Future()
+        with self._cond:
+            if not self._started:
+                self._started = True
+                for i in range(self.workers):
+                    threading.Thread(target=self._worker, name=f"download-worker-{i}", daemon=True).start()
+            if self.waiting() >= self.max_waiting:
+                return None, 0
+            job = (future, func, args)
+            self._queues.setdefault(user_id, deque()).append(job)
+            position = self._position(job)
+            self._cond.notify()
+        return future, position
+
+    def waiting(self):
+        return sum(len(jobs) for jobs in self._queues.values())
+
+    def _order(self):
+        """取り出される順にジョブを並べる（各ユーザーの1件目、2件目、…の順）"""
+        queues = list(self._queues.values())
+        for depth in range(max((len(jobs) for jobs in queues), default=0)):
+            for jobs in queues:
+                if depth < len(jobs):
+                    yield jobs[depth]
+
+    def _position(self, job):
+        for position, queued in enumerate(self._order(), 1):
+            if queued is job:
+                return position
+        return 0
+
+    def _take(self):
+        # 先頭のユーザーから1件取り出し、まだ残っていれば最後尾に回す
+        user_id, jobs = next(iter(self._queues.items()))
+        job = jobs.popleft()
+        if jobs:
+            self._queues.move_to_end(user_id)
+        else:
+            del self._queues[user_id]
+        return job
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while not self._queues:
+                    self._cond.wait()
+                future, func, args = self._take()
+                self.running += 1
+            try:
+                if future.set_running_or_notify_cancel():
+                    try:
+                        future.set_result(func(*args))
+                    except Exception as e:
+                        future.set_exception(e)
+            finally:
+                with self._cond:
+                    self.running -= 1
+
+download_queue = FairDownloadQueue(DOWNLOAD_WORKERS, DOWNLOAD_QUEUE_SIZE)
 
 # === ダウンロード処理 ===
 async def handle_download(interaction: Interaction, link: str, fmt: str, is_audio: bool):
     user_id = interaction.user.id
-    cmd_key = link + fmt
 
     if is_on_cooldown(user_id, fmt):
         await interaction.response.send_message("⏳ スパム防止のため3分待ってください。", ephemeral=True)
         return
 
-    if cmd_key in cache:
-        await interaction.response.send_message(f"✅ 既にアップ済みです：\n{cache[cmd_key]}", ephemeral=True)
+    cached_url = cache.get(link, fmt)
+    if cached_url:
+        await interaction.response.send_message(f"✅ 既にアップ済みです：\n{cached_url}", ephemeral=True)
         return
 
-    await interaction.response.send_message("📥 ダウンロード中... しばらくお待ちください。", ephemeral=True)
+    # ダウンロードとアップロードはワーカースレッドで実行し、イベントループを止めない
+    running = download_queue.running
+    future, position = download_queue.submit(user_id, download_and_upload, link, fmt, is_audio)
+    if future is None:
+        await interaction.response.send_message("🚧 混雑しています。しばらくしてから再度お試しください。", ephemeral=True)
+        return
+
+    if position <= DOWNLOAD_WORKERS - running:
+        await interaction.response.send_message("📥 ダウンロード中... しばらくお待ちください。", ephemeral=True)
+    else:
+        await interaction.response.send_message(
+            f"⏳ 順番待ちです（{position}番目 / 待機中 {download_queue.waiting()}件・実行中 {running}件）。"
+            "順番が来たら自動で開始します。",
+            ephemeral=True
+        )
 
     try:
-        url = download_and_upload(link, fmt, is_audio)
-        cache[cmd_key] = url
+        url = await asyncio.wrap_future(future)
+        cache.put(link, fmt, url)
         await interaction.followup.send(f"✅ 完了！ダウンロードリンク：\n{url}", ephemeral=True)
     except Exception as e:
         await interaction.followup.send(f"❌ エラー発生: {e}", ephemeral=True)